@@ -8,7 +8,57 @@ Options:
   --version
   --easy
   --fullscreen
+  --morph         Let the track morph and breathe, its checkpoints spiraling
+                  in and out around their places
+  --swarm         Every wave is a swarm of many small and weak monsters
+  --stamp-threshold=N
+                  Draw the monsters all at once with numpy when there are
+                  more than N of them (default: 500)
+  --threaded      Run the game rules in a thread of their own at a steady
+                  pace, however long drawing takes
   --profile
+  --detail=N      Always drop the N least important details when drawing,
+                  instead of dropping them only when frames get too slow
+  --frame-csv=FILE
+                  Write how long the phases of every frame took to a file
+  --max-towers=N  Allow up to N bubbles (default: 20)
+  --gravity=ENGINE
+                  Gravity engine: auto, python, numpy or cells
+  --numpy         Keep monsters in numpy arrays, for very large waves
+  --headless      Simulate a game without display, as fast as possible
+  --ticks=N       Number of ticks to simulate in headless mode
+  --renderer=NAME Draw headless games with this renderer: null (don't draw,
+                  the default), count (count the drawing calls) or pygame
+  --seed=N        Seed for the random numbers of the game
+  --skip-quiet    In headless games, jump over the time in which there are
+                  no monsters (the bubbles stop moving meanwhile)
+  --record=FILE   Record the game to a file, at a fixed timestep
+  --replay=FILE   Replay a recorded game as fast as possible and check that
+                  it ends the same way
+  --resume=FILE   Continue a game saved with F6
+  --rewind=N      How many seconds of the game can be rewound (default: 60)
+  --bench         Run the benchmark scenarios and print ticks per second
+                  for each subsystem, and check that the gravity engines
+                  agree
+  --bench-ticks=N, --bench-scenarios=NAME,...
+  --bench-out=FILE
+                  Save the benchmark results as JSON
+  --bench-baseline=FILE, --bench-threshold=FRACTION
+                  Compare with saved results and fail if a subsystem got
+                  slower by more than the threshold (default: 0.1)
+  --policy=NAME   How headless games are played: autoplay or scripted
+  --sweep         Play headless games for every combination of the --vary
+                  options, on all CPU cores, and report how they went
+  --vary=NAME=A,B,...  or  --vary=NAME=LOW:HIGH
+                  Values to try for a setting, e.g. --vary=hp_damage=0.3,0.6
+                  (ranges need --sweep-samples)
+  --sweep-samples=N
+                  Try N random combinations instead of all of them
+  --sweep-games=N, --sweep-jobs=N
+                  Games per combination (default: 4), worker processes
+  --sweep-out=FILE
+                  Save the results of every game as CSV, or JSON if the
+                  name ends in .json
  
 Key bindings:
 Space: Pause game
@@ -19,25 +69,43 @@ b: Add blue color from the bubble (shift+b to remove)
 Tab: Select next bubble
 0-9: Select certain bubbles, ordered by size
 F3: Send the next wave of enemies
+F4 or f: Fast-forward at 2x, 4x or 8x speed, or back to normal
 F11: Toggle fullscreen (unix only)
 F5: Clear the message log
+F9: Show how long the phases of a frame take
+Backspace: Rewind the game by a second
+F6: Save the game (F7 to load it again)
 Drag&Drop, Arrow Keys or hjkl: Move the active bubble
 Escape: quit"""
 
 import getpass
 import os.path
-import pygame
+import struct
 import sys
+import tempfile
+import threading
 import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import heapify, heappop, heappush
+from timeit import default_timer
 from collections import deque
-from math import sin, cos, atan2, pi, sqrt
-from pygame.locals import *
-from random import random, randint, choice, shuffle
+from functools import partial
+from math import sin, cos, atan2, floor, pi, sqrt
+from operator import xor
+from random import Random, randint
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+numpy = None  # imported by _import_numpy() when the first user needs it
+_numpy_missing = False
+pygame = None  # imported by _import_pygame() when a display is needed
 tau = 2 * pi
 
 # -- TODO --
 # Add more types of enemies?
-# Maps that morph and breathe, with edge points spiraling in and out
 
 
 class Globals(object):
@@ -46,13 +114,31 @@ class Globals(object):
     Variables that are initialized here never change, apart of the
     ones which only make sense to be defined in run_game().
     """
+    g.autoplay_interval = 5
+    g.bench = '--bench' in sys.argv
+    g.bench_baseline = _option('bench-baseline')
+    g.bench_out = _option('bench-out')
+    g.bench_threshold = float(_option('bench-threshold', 0.1))
+    g.bench_ticks = int(_option('bench-ticks', 300))
     g.color_step = 12
+    g.detail_budget = 0.8
+    g.detail_level = _option('detail')
     g.easy = '--easy' in sys.argv
+    g.fast_forward_budget = 0.8
     g.font_name = None
     g.font_size = 16, 24
+    g.frame_csv = _option('frame-csv')
+    g.frame_history = 300
     g.fullscreen = '--fullscreen' in sys.argv
+    g.gravity_engine = _option('gravity', 'auto')
+    if g.gravity_engine not in ('auto', 'python') and not _import_numpy():
+      g.gravity_engine = 'auto'
+    g.gravity_range = (25, 50) if g.easy else (10, 200)
+    g.grid_cell_size = 64
     g.growth_per_kill = 1
     g.growth_per_shot = 0.05
+    g.headless = '--headless' in sys.argv
+    g.highscore_limit = 100
     g.highscorefile = os.path.expanduser("~/.wabbel_highscore")
     g.hp_cost = 0.5 if g.easy else 1
     g.hp_damage = 0.3 if g.easy else 0.6
@@ -66,25 +152,76 @@ class Globals(object):
     ]
     g.max_drag_dist = 100
     g.maxfps = 30
-    g.max_towers = 20
+    g.max_dirty_rects = 400
+    g.max_towers = int(_option('max-towers', 20))
     g.min_hp_for_buying = 2
     g.monster_min_armor = 0.5
     g.monster_min_speed = 0.3
+    g.monster_pool_size = 4096
+    g.morph = '--morph' in sys.argv
+    g.morph_radius = 40
+    g.morph_speed = 0.4
+    g.morph_steps = 10
     try:
       g.name = os.environ.get("USER", getpass.getuser())
     except:
       g.name = "unknown"
+    g.numpy = '--numpy' in sys.argv and _import_numpy()
+    g.policy = _option('policy', 'autoplay')
     g.profile = '--profile' in sys.argv
     g.range_color = (32, 32, 32)
+    g.record = _option('record')
+    g.renderer_name = _option('renderer', 'null' if g.headless else 'pygame')
+    g.replay = _option('replay')
+    g.resume = _option('resume')
+    g.rewind_seconds = int(_option('rewind', 60))
+    g.savefile = os.path.expanduser("~/.wabbel_save")
+    g.seed = int(_option('seed', randint(0, 2**31 - 1)))
+    g.skip_quiet = '--skip-quiet' in sys.argv
+    g.sprite_cache_bytes = 8 << 20
+    g.sprite_color_step = 16
+    g.stamp_threshold = int(_option('stamp-threshold', 500))
+    g.stats_cache_size = 4096
+    g.stats_size_step = 0.05
+    g.sweep = '--sweep' in sys.argv
+    g.sweep_games = int(_option('sweep-games', 4))
+    g.sweep_jobs = _option('sweep-jobs')
+    g.sweep_out = _option('sweep-out')
+    g.sweep_samples = _option('sweep-samples')
+    g.swarm = '--swarm' in sys.argv
+    g.swarm_batch = 5
+    g.swarm_weight = 0.125
+    g.text_cache_bytes = 4 << 20
+    g.threaded = '--threaded' in sys.argv
+    g.ticks = int(_option('ticks', 30 * 60 * 10))
+    g.track_pulse_step = 6
     g.version = "0.2"
     g.waves_per_level = 10
     g.w, g.h = 800, 600
+    # the ones above are settings, which a sweep can vary
+    g.settings = frozenset(vars(g))
 
-    # initialized in run_game()
+    # the random numbers of the game, which are reproducible for replays
+    g.rng = Random(g.seed)
+    g.fixed_dt = 1.0 / g.maxfps if g.record else None
+    g.recorder = None
+    g.tick = 0
+
+    # initialized in init_display()
     g.clock = None
+    g.detail = None
+    g.fast_forward = None
     g.font = None
     g.font_small = None
-    g.screen = None
+    g.dirty = []
+    g.drawn_shake = None
+    g.redraw = True
+    g.renderer = None
+    g.rewind = None
+    g.simulation_thread = None
+    g.timer = None
+    g.track_key = None
+    g.track_points = None
 
     g.reset_game()
 
@@ -96,12 +233,18 @@ class Globals(object):
     g.active = None
     g.drag = None
     g.dt = 0
+    g.mouse = (0, 0)
     g.game_time = 0
     g.hp = 10
     g.level = 0
     g.logged = deque(maxlen=30)
     g.maxhp = g.hp
     g.mobs = []
+    g.monster_store = MonsterStore() if g.numpy else None
+    g.mob_grid = SpatialGrid(g.grid_cell_size)
+    g.damage_batch = DamageBatch()
+    g.events = Scheduler()
+    g.wave_event = None
     g.nextwave = 6.6
     g.nextwavemax = g.nextwave
     g.pause = False
@@ -109,6 +252,7 @@ class Globals(object):
     g.shake = (0, 0)
     g.shake_until = 0
     g.towers = list()
+    g.tower_grid = SpatialGrid(g.grid_cell_size * 2)
     g.waves = list()
     g.change_level()
 
@@ -117,24 +261,38 @@ class Globals(object):
     Variables that are initialized here are updated every time the level is
     changed, which occurs every g.waves_per_level waves.
     """
-    g.level_color = _random_color(0xaf)
+    g.level_color = _random_color(0xaf, g.rng)
     g.checkpoints = [(int(d[0] * g.w / 10), int(d[1] * g.h / 10)) for d in
-        choice(g.level_layouts)]
-    if randint(0,1) == 0:
+        g.rng.choice(g.level_layouts)]
+    if g.rng.randint(0,1) == 0:
       g.checkpoints = [(g.w-d[0], d[1]) for d in g.checkpoints]
-    if randint(0,1) == 0:
+    if g.rng.randint(0,1) == 0:
       g.checkpoints = [(d[0], g.h-d[1]) for d in g.checkpoints]
-    if randint(0,1) == 0:
+    if g.rng.randint(0,1) == 0:
       g.checkpoints.reverse()
+    g.base_checkpoints = list(g.checkpoints)
+    g.morph_step = None
+    g.path = Path(g.checkpoints)
 
     # global gravity
-    if g.easy or randint(0,3) == 0:
+    if g.easy or g.rng.randint(0,3) == 0:
       g.gravity = (0, 0)
     else:
-      g.gravity = (0, 0.001 * randint(0, min(100, g.level * 3)))
-      if randint(0, 2) == 0:
+      g.gravity = (0, 0.001 * g.rng.randint(0, min(100, g.level * 3)))
+      if g.rng.randint(0, 2) == 0:
         # vertical gravity instead
-        g.gravity = (choice([1, -1]) * g.gravity[1], 0)
+        g.gravity = (g.rng.choice([1, -1]) * g.gravity[1], 0)
+
+  @property
+  def nextwave(g):
+    """Seconds until the next wave is sent"""
+    return max(0.0, g.wave_event[0] - g.game_time)
+
+  @nextwave.setter
+  def nextwave(g, seconds):
+    if g.wave_event:
+      g.events.cancel(g.wave_event)
+    g.wave_event = g.events.at(g.game_time + seconds, _send_wave)
 
   def log(g, *things):
     g.logged.extend([str(obj) for obj in things])
@@ -143,40 +301,63 @@ class Globals(object):
     g.hp = 0
     g.log("You have lost the game! Press F8 to restart.")
     g.log("Final Score: %d" % g.score)
-    try:
-      highscores = open(g.highscorefile, "r").read().strip().split("\n")
-    except:
-      highscores = []
-
-    if g.score > 0:
-      highscores.append("%d - %s" % (g.score, g.name + (" (easy)" if g.easy else "")))
-      highscores.sort(key=_highscore_sorting_key)
-      highscores.reverse()
-      f = open(g.highscorefile, "w")
-      f.write("\n".join(highscores) + "\n")
+    store = HighscoreStore(g.highscorefile, g.highscore_limit)
+    if g.score > 0 and not g.headless:
+      try:
+        store.add(g.score, g.name + (" (easy)" if g.easy else ""))
+      except (IOError, OSError):
+        g.log("Could not save the high score to %s" % g.highscorefile)
+    else:
+      store.load()
 
-    g.log(" ", "Top 10:", *highscores[:10])
+    g.log(" ", "Top 10:", *store.lines(10))
 
 
 def run_game():
   """
   Start the game, initialize pygame and run the input/draw loop
   """
-  pygame.init()
-  pygame.font.init()
-  pygame.key.set_repeat(180, 80)
-  flags = DOUBLEBUF | (g.fullscreen and FULLSCREEN)
-  g.screen = pygame.display.set_mode((g.w, g.h), flags, 32)
-  g.font_small = pygame.font.Font(g.font_name, g.font_size[0])
-  g.font = pygame.font.Font(g.font_name, g.font_size[1])
-  g.clock = pygame.time.Clock()
+  init_display('pygame')
   g.log("Welcome! Press F1 to display help.")
-
+  if g.record:
+    g.recorder = Recorder(g.record)
+  g.timer = FrameTimer(g.frame_history, g.frame_csv)
+  g.fast_forward = FastForward(g.fast_forward_budget / g.maxfps)
+  # only played games can be rewound, the snapshots would slow down the rest
+  g.rewind = RewindBuffer(g.rewind_seconds) if g.rewind_seconds else None
+  try:
+    _game_loop()
+  finally:
+    if g.simulation_thread:
+      g.simulation_thread.stop()
+      g.simulation_thread = None
+    g.timer.close()
+    if g.recorder:
+      g.recorder.close()
+      g.recorder = None
+
+
+def init_display(renderer=None):
+  """Open the renderer (by default g.renderer_name) and set up drawing"""
+  g.renderer = _renderers[renderer or g.renderer_name]()
+  g.renderer.open()
+  g.dirty = []
+  g.redraw = True
+  g.track_key = None
+  g.track_points = None
+  g.detail = DetailLevel(g.detail_budget / g.maxfps,
+      None if g.detail_level is None else int(g.detail_level))
+
+
+def _game_loop():
+  sim = Simulation()
+  if g.threaded:
+    g.simulation_thread = SimulationThread(sim)
+    g.simulation_thread.start()
   next_log_refresh = 0
-
   while True:
-    time_before = time.time()
-    g.clock.tick(g.maxfps)
+    dt = g.clock.tick(g.maxfps) / 1000.0
+    g.timer.start()
     if next_log_refresh <= time.time():
       next_log_refresh = time.time() + 1
       g.log("")
@@ -188,130 +369,977 @@ def run_game():
         keypress(event.key)
       elif event.type in (MOUSEBUTTONDOWN, MOUSEBUTTONUP):
         click(event.type, event.pos, event.button)
+      elif event.type == VIDEOEXPOSE:
+        g.redraw = True
+    g.timer.mark('events')
     keyhold(pygame.key.get_pressed())
+    g.timer.mark('keyhold')
 
-    # Handle waves, monsters and towers:
-    if g.hp > 0 and not g.pause:
-      if g.towers or g.level:
-        if g.level and g.level % g.waves_per_level == 0:
-          if g.mobs:
-            g.nextwave = g.nextwavemax
-          else:
-            g.change_level()
-            g.nextwave = 0
-
-        g.nextwave -= g.dt
-        if g.nextwave <= 0:
-          g.nextwave = g.nextwavemax
-          g.level += 1
-          g.log("Wave %d" % g.level)
-          g.waves.append(Wave(g.level))
-
-      for wave in list(g.waves):
-        if wave.monsters_left > 0:
-          wave.tick()
-        else:
-          g.waves.remove(wave)
+    if g.simulation_thread:
+      if not g.simulation_thread.thread.is_alive():
+        raise RuntimeError("The simulation thread has stopped")
+      draw_game()
+      g.timer.end()
+      continue
 
-      for mob in list(g.mobs):
-        if mob.hp <= 0:
-          g.mobs.remove(mob)
-        else:
-          mob.walk()
-
-    if g.hp > 0 and not g.pause:
-      g.towers.sort(key=lambda tower: -tower.size)
-      for i, tower in enumerate(tuple(g.towers)):
-        tower.walk()
-        # gravitational attraction:
-        for other in g.towers[i+1:]:
-          angle = atan2(tower.y - other.y, tower.x - other.x)
-          distance = tower.distance(other.x, other.y)
-          if int(distance) in (range(25, 50) if g.easy else range(10,200)):
-            g1 = tower.size + 1
-            g2 = other.size + 1
-            attraction = min(3, (g1 * g2) / distance**2)
-            tower.vx -= cos(angle) * attraction / g1 / tower.pinhead
-            tower.vy -= sin(angle) * attraction / g1 / tower.pinhead
-            other.vx += cos(angle) * attraction / g2 / other.pinhead
-            other.vy += sin(angle) * attraction / g2 / other.pinhead
-    draw_game()
+    ticks = g.fast_forward.speed
+    time_before = default_timer()
+    if ticks > 1:
+      for i in range(ticks):
+        sim.step(g.fixed_dt or 1.0 / g.maxfps)
+    else:
+      sim.step(g.fixed_dt or dt)
+    tick_time = default_timer() - time_before
+    draw_game(tick_time * (ticks - 1) / ticks)
+    g.timer.end()
+    g.fast_forward.update(ticks, tick_time, g.timer.current[-1])
+
+
+class FrameTimer(object):
+  """
+  Measures how long each phase of the recent frames took, for the overlay
+  and --frame-csv
+  """
+  phases = ('events', 'keyhold', 'waves', 'monsters', 'towers', 'gravity',
+      'draw', 'flip')
+
+  def __init__(self, size, csv_path=None):
+    self.size = size
+    self.index = 0
+    self.count = 0
+    self.frames = [[0.0] * (len(self.phases) + 1) for _ in range(size)]
+    self.columns = dict((phase, i) for i, phase in enumerate(self.phases))
+    self.current = self.frames[0]
+    self.last = 0
+    self.overlay = False
+    self.lines = []
+    self.csv = None
+    if csv_path:
+      self.csv = open(csv_path, 'w')
+      self.csv.write(",".join(('frame',) + self.phases + ('total',)) + "\n")
+
+  def start(self):
+    self.current = self.frames[self.index]
+    for i in range(len(self.current)):
+      self.current[i] = 0.0
+    self.last = default_timer()
+
+  def mark(self, phase):
+    """Attribute the time since the last mark to the phase"""
+    now = default_timer()
+    self.current[self.columns[phase]] += now - self.last
+    self.last = now
+
+  def end(self):
+    self.current[-1] = sum(self.current[:-1])
+    if self.csv:
+      self.csv.write("%d,%s\n" % (self.count, ",".join("%.3f" % (t * 1000)
+        for t in self.current)))
+    self.count += 1
+    self.index = (self.index + 1) % self.size
+    if self.overlay and self.count % 15 == 0:
+      self.lines = None
+
+  def percentiles(self, column, fractions=(0.5, 0.95, 0.99)):
+    times = sorted(frame[column] for frame in self.frames[:min(self.count, self.size)])
+    if not times:
+      return [0.0] * len(fractions)
+    return [times[min(len(times) - 1, int(f * len(times)))] for f in fractions]
+
+  def report(self):
+    """The lines of the overlay, only updated every 15 frames"""
+    if not self.lines:
+      budget = 1.0 / g.maxfps
+      self.lines = ["phase  p50 / p95 / p99 ms"]
+      for phase in self.phases:
+        self.lines.append("%s  %s" % (phase, " / ".join("%.1f" % (t * 1000)
+          for t in self.percentiles(self.columns[phase]))))
+      p50, p95, p99 = self.percentiles(len(self.phases))
+      self.lines.append("frame  %.1f / %.1f / %.1f ms" % (p50 * 1000,
+        p95 * 1000, p99 * 1000))
+      self.lines.append("budget  %d%% / %d%% / %d%% of %.1f ms" % (
+        100 * p50 / budget, 100 * p95 / budget, 100 * p99 / budget,
+        budget * 1000))
+      if g.detail and g.detail.level:
+        self.lines.append("dropped  %s" % ", ".join(
+          g.detail.features[:g.detail.level]))
+    return self.lines
+
+  def close(self):
+    if self.csv:
+      self.csv.close()
+      self.csv = None
+
+
+class FastForward(object):
+  """
+  Runs several normal ticks per frame, half as many while they don't fit
+  into the budget (in seconds)
+  """
+  speeds = (1, 2, 4, 8)
+
+  def __init__(self, budget):
+    self.budget = budget
+    self.chosen = self.speed = 1
+    self.tick_time = 0.0  # the average time of a tick
+    self.other_time = 0.0  # the average time of the rest of a frame
+    self.wait = 0
+
+  def cycle(self):
+    """Choose the next faster speed, or the normal speed after the fastest"""
+    i = self.speeds.index(self.chosen)
+    self.chosen = self.speed = self.speeds[(i + 1) % len(self.speeds)]
+    self.wait = 15
+
+  def update(self, ticks, tick_time, frame_time):
+    self.tick_time += (tick_time / ticks - self.tick_time) * 0.1
+    self.other_time += (frame_time - tick_time - self.other_time) * 0.1
+    if self.wait > 0:
+      self.wait -= 1
+      return
+    room = self.budget - self.other_time
+    if self.speed > 1 and self.speed * self.tick_time > room:
+      self.speed //= 2
+      self.wait = 15
+    elif self.speed < self.chosen and \
+        self.speed * 2 * self.tick_time < room * 0.7:
+      self.speed *= 2
+      self.wait = 60
+
+
+class DetailLevel(object):
+  """
+  Decides which details draw_game() leaves out to keep frames within the
+  budget (in seconds), unless the level is fixed
+  """
+  features = ('range', 'beams', 'rotation', 'checkpoints', 'log')
+
+  def __init__(self, budget, fixed=None):
+    self.budget = budget
+    self.fixed = fixed is not None
+    self.average = 0.0
+    self.wait = 0
+    self.set_level(fixed or 0)
+
+  def set_level(self, level):
+    self.level = max(0, min(len(self.features), level))
+    for i, feature in enumerate(self.features):
+      setattr(self, feature, i >= self.level)
+
+  def update(self, cost):
+    self.average += (cost - self.average) * 0.1
+    if self.fixed:
+      return
+    if self.wait > 0:
+      self.wait -= 1
+    elif self.average > self.budget and self.level < len(self.features):
+      self.set_level(self.level + 1)
+      self.wait = 15
+    elif self.average < self.budget * 0.5 and self.level > 0:
+      self.set_level(self.level - 1)
+      self.wait = 60
+
+
+def simulate():
+  """
+  Advance waves, monsters and towers by g.dt.  This contains all the game
+  rules and must not touch the display, so it can also run headless.
+  """
+  timer = None if g.simulation_thread else g.timer  # not its frames
+  if g.hp > 0 and not g.pause:
+    update_waves()
+    if timer: timer.mark('waves')
+    move_monsters()
+    if timer: timer.mark('monsters')
+
+  if g.hp > 0 and not g.pause:
+    g.towers.sort(key=lambda tower: -tower.size)
+    update_auras()
+    g.events.run(g.game_time)  # auras may have made bubbles ready to shoot
+    for tower in tuple(g.towers):
+      tower.walk()
+    g.damage_batch.resolve()
+    if timer: timer.mark('towers')
+    apply_gravity()
+    if timer: timer.mark('gravity')
+
+
+def update_waves():
+  """
+  Hold the countdown to the next wave while it shouldn't run, and carry out
+  everything that is due
+  """
+  if g.towers or g.level:
+    if g.level and g.level % g.waves_per_level == 0:
+      if g.mobs:
+        g.nextwave = g.nextwavemax
+      else:
+        g.change_level()
+        g.nextwave = 0
+  else:
+    g.nextwave += g.dt  # the countdown starts with the first bubble
+
+  g.events.run(g.game_time)
+
+
+def _send_wave():
+  g.nextwave = g.nextwavemax
+  g.level += 1
+  g.log("Wave %d" % g.level)
+  g.waves.append(Wave(g.level))
+
+
+class Scheduler(object):
+  """Calls functions once g.game_time reaches a given time"""
+  def __init__(self):
+    self.heap = []
+    self.count = 0  # breaks ties, so calls for the same time keep their order
+    self.cancelled = 0
+
+  def at(self, when, function, *args):
+    """Schedule a call, returns a handle for cancel()"""
+    entry = [when, self.count, function, args]
+    self.count += 1
+    heappush(self.heap, entry)
+    return entry
+
+  def cancel(self, entry):
+    if entry[2] is not None:
+      entry[2] = None
+      self.cancelled += 1
+      if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+        self.heap = [entry for entry in self.heap if entry[2] is not None]
+        heapify(self.heap)
+        self.cancelled = 0
+
+  def next_time(self):
+    """The time of the next pending call, or None"""
+    heap = self.heap
+    while heap and heap[0][2] is None:
+      heappop(heap)
+      self.cancelled -= 1
+    return heap[0][0] if heap else None
+
+  def run(self, now):
+    """Make all calls that are due at the given time, in order"""
+    heap = self.heap
+    while heap and heap[0][0] <= now:
+      entry = heappop(heap)
+      function = entry[2]
+      if function is None:
+        self.cancelled -= 1
+      else:
+        entry[2] = None
+        function(*entry[3])
+
+
+def move_monsters():
+  """Walk the monsters and drop the dead ones"""
+  if g.morph:
+    morph_track()
+  if g.monster_store is not None:
+    g.monster_store.compact()
+    g.monster_store.walk()
+  else:
+    alive, dead = [], []
+    for mob in g.mobs:
+      if mob.hp <= 0:
+        dead.append(mob)
+      else:
+        mob.walk()
+        alive.append(mob)
+    g.mobs = alive
+    _recycle(dead)
+    # Sorting by danger makes every grid cell list its most dangerous
+    # monster first, which Tower._get_target() relies on.  The order
+    # barely changes between ticks, so this is cheap.
+    g.mobs.sort(key=_get_danger, reverse=True)
+    g.mob_grid.rebuild(g.mobs)
+
+
+def morph_track():
+  """
+  Move the checkpoints along breathing spirals around their places in the
+  layout, g.morph_steps times per second.  The ends stay where they are.
+  """
+  base = g.base_checkpoints
+  step = floor(g.game_time * g.morph_steps)
+  if len(base) < 3 or step == g.morph_step:
+    return
+  g.morph_step = step
+  t = step / g.morph_steps * g.morph_speed
+  if g.numpy:
+    x, y = numpy.array(base[1:-1], float).T
+    phase = numpy.arange(1, len(base) - 1) * 2.4
+    radius = g.morph_radius * 0.5 * (1 - numpy.cos(t * 0.37 + phase))
+    x = numpy.floor(x + radius * numpy.cos(t + phase) + 0.5).clip(0, g.w)
+    y = numpy.floor(y + radius * numpy.sin(t + phase) + 0.5).clip(0, g.h)
+    inner = list(zip(x.astype(int).tolist(), y.astype(int).tolist()))
+  else:
+    inner = []
+    for i in range(1, len(base) - 1):
+      phase = i * 2.4
+      radius = g.morph_radius * 0.5 * (1 - cos(t * 0.37 + phase))
+      x = floor(base[i][0] + radius * cos(t + phase) + 0.5)
+      y = floor(base[i][1] + radius * sin(t + phase) + 0.5)
+      inner.append((int(min(g.w, max(0, x))), int(min(g.h, max(0, y)))))
+  points = [base[0]] + inner + [base[-1]]
+  moved = g.path.move(points)
+  if moved:
+    g.checkpoints = points
+    _reproject_monsters(*moved)
+
+
+def _reproject_monsters(old_start, old_lengths):
+  """
+  Keep the monsters at the same fraction of the segment they are on after
+  the path moved, given the arc lengths of the segments before
+  """
+  path = g.path
+  store = g.monster_store
+  if store is not None:
+    n = store.n
+    i = store.checkpoint[:n]
+    old_length = numpy.array(old_lengths)[i]
+    walked = store.danger[:n] - numpy.array(old_start)[i]
+    ratio = walked / numpy.where(old_length > 0, old_length, 1)
+    _, _, _, start = path.arrays()
+    store.danger[:n] = start[i] + ratio * numpy.array(path.lengths)[i]
+  else:
+    start, lengths = path.start, path.lengths
+    for mob in g.mobs:
+      i = mob.checkpoint
+      if old_lengths[i]:
+        mob.danger = start[i] + \
+            (mob.danger - old_start[i]) * lengths[i] / old_lengths[i]
+      else:
+        mob.danger = start[i]
+
+
+def apply_gravity():
+  """The gravitational attraction between the bubbles"""
+  if len(g.towers) > 1:
+    _gravity_engines[_choose_gravity_engine()](g.towers)
+
+
+def update_auras():
+  """
+  Give every bubble the damage bonus of the strongest magenta bubble that
+  has it in range.  The effects don't stack.
+  """
+  bonus = {}
+  supporters = [tower for tower in g.towers if tower.support > 0]
+  if supporters:
+    g.tower_grid.rebuild(g.towers)
+    for supporter in supporters:
+      x, y, r = supporter.x, supporter.y, supporter.range
+      for tower in g.tower_grid.query(r, x, y):
+        if tower is not supporter and tower.distance(x, y) < r and \
+            bonus.get(tower, 0) < supporter.support:
+          bonus[tower] = supporter.support
+  for tower in g.towers:
+    support = bonus.get(tower, 0)
+    if tower.bonus_damage != support:
+      tower.bonus_damage = support
+      tower.update_stats()
+
+
+def _gravity_python(towers):
+  """
+  Gravitational attraction between bubbles, pair by pair.  This is the
+  reference implementation of the rules for the other engines.
+  """
+  low, high = g.gravity_range
+  for i, tower in enumerate(towers):
+    for other in towers[i+1:]:
+      angle = atan2(tower.y - other.y, tower.x - other.x)
+      distance = tower.distance(other.x, other.y)
+      if low <= distance < high:
+        g1 = tower.size + 1
+        g2 = other.size + 1
+        attraction = min(3, (g1 * g2) / distance**2)
+        tower.vx -= cos(angle) * attraction / g1 / tower.pinhead
+        tower.vy -= sin(angle) * attraction / g1 / tower.pinhead
+        other.vx += cos(angle) * attraction / g2 / other.pinhead
+        other.vy += sin(angle) * attraction / g2 / other.pinhead
+
+
+def _gravity_forces(x, y, mass, x2, y2, mass2):
+  """
+  The velocity changes of the bubbles at (x, y) caused by the ones at
+  (x2, y2), as numpy arrays
+  """
+  low, high = g.gravity_range
+  dx = x[:, None] - x2[None, :]
+  dy = y[:, None] - y2[None, :]
+  distance = numpy.hypot(dx, dy)
+  near = (distance >= low) & (distance < high)
+  distance[~near] = 1
+  attraction = numpy.minimum(3, mass[:, None] * mass2[None, :] / distance**2)
+  attraction *= near
+  attraction /= distance
+  return (-(dx * attraction).sum(1) / mass, -(dy * attraction).sum(1) / mass)
+
+
+def _gravity_numpy(towers, cell_size=None):
+  """
+  Vectorized gravity, over all pairs at once or, with cell_size, over the
+  3x3 cells around each cell
+  """
+  x = numpy.array([tower.x for tower in towers], float)
+  y = numpy.array([tower.y for tower in towers], float)
+  mass = numpy.array([tower.size + 1 for tower in towers], float)
+  pinhead = numpy.array([tower.pinhead for tower in towers], float)
+  if cell_size is None:
+    dvx, dvy = _gravity_forces(x, y, mass, x, y, mass)
+  else:
+    dvx, dvy = numpy.zeros(len(towers)), numpy.zeros(len(towers))
+    cx = (x // cell_size).astype(int)
+    cy = (y // cell_size).astype(int)
+    cells = {}
+    for i, key in enumerate(zip(cx.tolist(), cy.tolist())):
+      cells.setdefault(key, []).append(i)
+    for (i, j), members in cells.items():
+      near = [k for a in (i-1, i, i+1) for b in (j-1, j, j+1)
+          for k in cells.get((a, b), ())]
+      near = numpy.array(near)
+      members = numpy.array(members)
+      dvx[members], dvy[members] = _gravity_forces(x[members], y[members],
+          mass[members], x[near], y[near], mass[near])
+  dvx /= pinhead
+  dvy /= pinhead
+  for tower, ax, ay in zip(towers, dvx.tolist(), dvy.tolist()):
+    tower.vx += ax
+    tower.vy += ay
+
+
+def _gravity_cells(towers):
+  _gravity_numpy(towers, cell_size=g.gravity_range[1])
+
+
+_gravity_engines = {
+  'python': _gravity_python,
+  'numpy': _gravity_numpy,
+  'cells': _gravity_cells,
+}
+
+
+def _choose_gravity_engine():
+  if g.gravity_engine != 'auto':
+    return g.gravity_engine
+  count = len(g.towers)
+  if count < 16 or not _import_numpy():
+    return 'python'
+  return 'numpy' if count < 200 else 'cells'
+
+
+def _gravity_parity(count=300, seed=1):
+  """
+  Return how far the velocities of the gravity engines differ at most from
+  those of the python one, for count bubbles placed at random
+  """
+  global g
+  saved, g = g, Globals()  # new bubbles use g.rng and g.events
+  try:
+    rng = Random(seed)
+    towers = []
+    for i in range(count):
+      tower = Tower()
+      tower.x, tower.y = rng.uniform(0, g.w), rng.uniform(0, g.h)
+      tower.red, tower.green, tower.blue = [rng.randint(0, 255) for _ in 'rgb']
+      tower.size = rng.uniform(0, 100)
+      tower.update_stats()
+      towers.append(tower)
+    velocities = {}
+    for name, engine in _gravity_engines.items():
+      for tower in towers:
+        tower.vx = tower.vy = 0.0
+      engine(towers)
+      velocities[name] = [v for tower in towers for v in (tower.vx, tower.vy)]
+  finally:
+    g = saved
+  reference = velocities.pop('python')
+  return max(abs(a - b) for others in velocities.values()
+      for a, b in zip(others, reference))
+
+
+class Simulation(object):
+  """
+  Runs the game rules at a fixed timestep, without a display.  The policy
+  is called before each step.
+  """
+  def __init__(self, dt=None, policy=None):
+    self.dt = dt or 1.0 / g.maxfps
+    self.policy = policy
+    self.ticks = 0
+
+  def step(self, dt=None):
+    if self.policy:
+      self.policy(self)
+    # after the commands of this tick, like those of a player before it
+    if g.rewind and g.tick % g.maxfps == 0:
+      g.rewind.take()
+    g.dt = self.dt if dt is None else dt
+    simulate()
     if not g.pause:
-      g.dt = time.time() - time_before
       g.game_time += g.dt
+    self.ticks += 1
+    g.tick += 1
+
+  def run(self, ticks):
+    """Advance the given number of ticks or until the game is lost"""
+    end = self.ticks + ticks
+    while self.ticks < end:
+      if g.hp <= 0:
+        break
+      if g.skip_quiet:
+        self.skip_quiet(end - self.ticks - 1)
+      self.step()
+    return self.ticks
+
+  def skip_quiet(self, limit):
+    """
+    Jump over up to limit ticks in which only bubbles would move, and return
+    how many.  The bubbles stay where they are.
+    """
+    if g.mobs or g.waves or g.pause or not (g.towers or g.level):
+      return 0
+    if g.level and g.level % g.waves_per_level == 0:
+      return 0  # update_waves() changes the level on the next tick
+    when = g.events.next_time()
+    if when is None:
+      return 0
+    ticks = min(limit, int((when - g.game_time) / self.dt) - 1)
+    if ticks <= 0:
+      return 0
+    g.game_time += ticks * self.dt
+    self.ticks += ticks
+    g.tick += ticks
+    return ticks
+
+
+class SimulationThread(object):
+  """
+  Runs the simulation with --threaded in a thread of its own, at g.maxfps
+  batches of ticks per second, while draw_game() interpolates between them.
+  """
+  jump = 50  # moving further than this in a batch isn't interpolated
+  catch_up = 8  # how many batches may be run late after a stall
+
+  def __init__(self, sim):
+    self.sim = sim
+    self.interval = 1.0 / g.maxfps
+    self.queue = deque()
+    self.lock = threading.Lock()
+    positions = Positions()
+    self.positions = (positions, positions)
+    self.placed = False
+    self.draw_start = 0.0
+    self.draw_time = 0.0
+    self.running = True
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    """Let the thread finish its batch of ticks and end"""
+    self.running = False
+    self.thread.join(1.0)  # it never ends if drawing failed with the lock held
+
+  def call(self, function, *args):
+    """
+    Let the thread call function(*args) before its next batch of ticks.
+    Returns False without doing so when called on the thread itself.
+    """
+    if threading.current_thread() is self.thread:
+      return False
+    self.queue.append((function, args))
+    return True
+
+  def run(self):
+    next_time = default_timer()
+    while self.running:
+      now = default_timer()
+      if now < next_time:
+        time.sleep(next_time - now)
+        continue
+      next_time = max(next_time, now - self.catch_up * self.interval) + \
+          self.interval
+      with self.lock:
+        self.tick()
 
+  def tick(self):
+    """Carry out the queued input, then a batch of ticks"""
+    before = self.positions[1]
+    if self.queue:
+      while self.queue:
+        function, args = self.queue.popleft()
+        function(*args)
+      before = Positions()  # e.g. rewinding doesn't move anything smoothly
+    ticks = g.fast_forward.speed
+    time_before = default_timer()
+    for i in range(ticks):
+      self.sim.step(g.fixed_dt or self.interval)
+    tick_time = default_timer() - time_before
+    # drawing takes its time from the same budget
+    g.fast_forward.update(ticks, tick_time, tick_time + self.draw_time)
+    self.positions = (before, Positions())
+
+  def begin_draw(self):
+    """
+    Take the lock and move the actors part of the way from where they were
+    before the last batch of ticks to where they are now
+    """
+    self.lock.acquire()
+    self.draw_start = default_timer()
+    before, after = self.positions
+    alpha = (self.draw_start - after.time) / self.interval
+    self.placed = alpha < 1
+    if self.placed:
+      after.place(after.between(before, alpha, self.jump))
+
+  def end_draw(self):
+    """Put the actors back and release the lock"""
+    if self.placed:
+      after = self.positions[1]
+      after.place((after.tower_x, after.tower_y, after.mob_x, after.mob_y))
+    self.draw_time = default_timer() - self.draw_start
+    self.lock.release()
+
+
+class Positions(object):
+  """
+  A copy of where the bubbles and the monsters are, which doesn't change
+  when they move on
+  """
+  __slots__ = ('time', 'towers', 'tower_x', 'tower_y', 'mobs', 'mob_x',
+      'mob_y')
+
+  def __init__(self):
+    self.time = default_timer()
+    self.towers = tuple(g.towers)
+    self.tower_x = [tower.x for tower in self.towers]
+    self.tower_y = [tower.y for tower in self.towers]
+    self.mobs = tuple(g.mobs)
+    store = g.monster_store
+    if store is not None:
+      self.mob_x = store.x[:store.n].copy()
+      self.mob_y = store.y[:store.n].copy()
+    else:
+      self.mob_x = [mob.x for mob in self.mobs]
+      self.mob_y = [mob.y for mob in self.mobs]
 
-def draw_game():
+  def between(self, before, alpha, jump):
+    """
+    The positions alpha of the way from before to here, as tower_x, tower_y,
+    mob_x and mob_y.  Actors that are new or jumped stay here.
+    """
+    return (_interpolate(self.towers, self.tower_x, self.tower_y,
+        before.towers, before.tower_x, before.tower_y, alpha, jump) +
+      _interpolate(self.mobs, self.mob_x, self.mob_y, before.mobs,
+        before.mob_x, before.mob_y, alpha, jump))
+
+  def place(self, positions):
+    """Move the actors to (tower_x, tower_y, mob_x, mob_y)"""
+    tower_x, tower_y, mob_x, mob_y = positions
+    for tower, x, y in zip(self.towers, tower_x, tower_y):
+      tower.x = x
+      tower.y = y
+    store = g.monster_store
+    if store is not None:
+      store.x[:len(self.mobs)] = mob_x
+      store.y[:len(self.mobs)] = mob_y
+    else:
+      for mob, x, y in zip(self.mobs, mob_x, mob_y):
+        mob.x = x
+        mob.y = y
+
+
+def _interpolate(actors, x, y, old_actors, old_x, old_y, alpha, jump):
+  """See Positions.between(), x and y are lists or numpy arrays"""
+  if not old_actors:
+    return x, y
+  index = dict(zip(old_actors, range(len(old_actors))))
+  old = [index.get(actor, -1) for actor in actors]
+  if not isinstance(x, list):
+    old = numpy.array(old, int)
+    dx = numpy.where(old >= 0, x - old_x[old], 0)
+    dy = numpy.where(old >= 0, y - old_y[old], 0)
+    far = numpy.abs(dx) + numpy.abs(dy) >= jump
+    dx[far] = dy[far] = 0
+    return x - dx * (1 - alpha), y - dy * (1 - alpha)
+  x, y = list(x), list(y)
+  for i, j in enumerate(old):
+    if j >= 0:
+      dx, dy = x[i] - old_x[j], y[i] - old_y[j]
+      if abs(dx) + abs(dy) < jump:
+        x[i] -= dx * (1 - alpha)
+        y[i] -= dy * (1 - alpha)
+  return x, y
+
+
+def autoplay(sim):
   """
-  Draw the level, the UI and the actors.
+  A trivial player for headless games: it creates a new bubble every few
+  seconds until g.max_towers is reached.
   """
-  g.screen.fill((0, 0, 0))
-  if g.active:
-    pygame.draw.circle(g.screen, g.range_color, g.active.pos, g.active.range, 0)
-    pygame.draw.line(g.screen, g.active.color, g.active.pos,
-        (g.active.x + cos(g.game_time*3) * g.active.range,
-         g.active.y - sin(g.game_time*3) * g.active.range), 2)
+  if len(g.towers) < g.max_towers and \
+      g.game_time >= len(g.towers) * g.autoplay_interval:
+    command('create')
+
+
+class ScriptedPlayer(object):
+  """
+  A player for headless games that places, drags and paints bubbles by a
+  fixed script
+  """
+  channels = ('red', 'green', 'blue')
+
+  def __init__(self, reserve=3, drag_time=2.0):
+    self.reserve = reserve
+    self.drag_time = drag_time
+    self.release_at = 0
+    self.target = None
+    self.assigned = {}
+
+  def __call__(self, sim):
+    if g.drag:
+      if g.game_time >= self.release_at:
+        command('release')
+      else:
+        command('mouse', *self.target)
+    elif len(g.towers) < g.max_towers and \
+        g.game_time >= len(g.towers) * g.autoplay_interval:
+      command('create')
+      tower = g.active
+      self.assigned[tower] = self.channels[len(self.assigned) % 3]
+      self.target = g.checkpoints[len(self.assigned) % len(g.checkpoints)]
+      self.release_at = g.game_time + self.drag_time
+      command('grab', int(tower.x), int(tower.y))
+
+    if g.hp >= g.min_hp_for_buying + self.reserve:
+      for tower in g.towers:
+        channel = self.assigned.get(tower)
+        if channel and getattr(tower, channel) < 255:
+          command('select', g.towers.index(tower))
+          command('paint', channel, 1)
+          break
 
+
+_policies = {'autoplay': autoplay, 'scripted': ScriptedPlayer}
+
+
+def _make_policy(name):
+  """Return the policy called name, a new one if it keeps state"""
+  policy = _policies[name]
+  return policy() if isinstance(policy, type) else policy
+
+
+def run_headless():
+  """
+  Simulate g.ticks ticks of an autoplayed game and print a summary
+  """
+  sim = Simulation(policy=_make_policy(g.policy))
+  draw = g.renderer_name != 'null'
+  if draw:
+    init_display()
+  time_before = time.time()
+  if draw:
+    for _ in range(g.ticks):
+      if g.hp <= 0:
+        break
+      sim.step()
+      draw_game()
+  else:
+    sim.run(g.ticks)
+  elapsed = max(1e-9, time.time() - time_before)
+  print("seed: %d, ticks: %d (%.1fs of game time)" % (g.seed, sim.ticks,
+    g.game_time))
+  print("elapsed: %.2fs, %.0f ticks per second" % (elapsed, sim.ticks / elapsed))
+  print("level: %d, score: %d, hp: %.1f, towers: %d, monsters: %d" % (
+    g.level, g.score, max(0, g.hp), len(g.towers), len(g.mobs)))
+  if hasattr(g.renderer, 'report'):
+    print(g.renderer.report())
+
+
+def draw_game(fast_forward_time=0):
+  """
+  Draw the level, the UI and the actors, and update the parts of the screen
+  that changed.  fast_forward_time doesn't count for the detail level.
+  """
+  time_before = default_timer()
+  thread = g.simulation_thread
+  if thread:
+    thread.begin_draw()
+  detail = g.detail
+  r = g.renderer
   if g.shake_until > g.game_time:
     g.shake = (randint(-3,3), randint(-3,3))
+  moved = _update_track()
+  redraw = moved is True or g.redraw or g.shake != g.drawn_shake
+  if redraw:
+    r.fill((0, 0, 0))
+    r.blit_track(g.shake)
+    moved = []
+  else:
+    moved = [rect.move(g.shake) for rect in moved]
+    for rect in g.dirty + moved:
+      _restore_track(rect)
 
-  normal = [int(max(0, min(255, 24 * sin(g.game_time) + clr))) for clr in g.level_color]
-  dark = [int(clr*0.5) for clr in normal]
-  checkpoints = tuple((dot[0] + g.shake[0], dot[1] + g.shake[1]) for dot in g.checkpoints)
-  pygame.draw.lines(g.screen, dark, False, checkpoints, 10)
-  pygame.draw.lines(g.screen, normal, False, checkpoints, 2)
-  for dot in checkpoints:
-    pygame.draw.circle(g.screen, dark, (dot[0], dot[1] + 1), 8, 0)
-    pygame.draw.circle(g.screen, normal, (dot[0], dot[1] + 1), 8, 1)
+  rects = []
+  if g.active:
+    rect = r.circle(g.range_color, g.active.pos, g.active.range,
+        0 if detail.range else 1)
+    rects.append(rect)
+    rects.append(r.line(g.active.color, g.active.pos,
+        (g.active.x + cos(g.game_time*3) * g.active.range,
+         g.active.y - sin(g.game_time*3) * g.active.range), 2))
+    # the range is drawn below the track
+    r.blit_track(rect.topleft, rect.move(-g.shake[0], -g.shake[1]))
 
-  for mob in g.mobs:
-    mob.draw()
+  if len(g.mobs) > g.stamp_threshold and _import_numpy():
+    rects.extend(_stamp_monsters())
+  else:
+    for mob in g.mobs:
+      rects.append(mob.draw())
 
   for tower in tuple(g.towers):
-    tower.draw()
+    rects.append(tower.draw())
 
   if g.drag:
-    pygame.draw.line(g.screen, g.drag.color, g.drag.pos, pygame.mouse.get_pos(), 3)
+    rects.append(r.line(g.drag.color, g.drag.pos, g.mouse, 3))
 
-  _draw_bar(g.w-120, 15, int(100*g.nextwave/g.nextwavemax), 2, (150, 150, 0))
+  rects.append(_draw_bar(g.w-120, 15, int(100*g.nextwave/g.nextwavemax), 2, (150, 150, 0)))
   if g.hp > 0:
-    _draw_bar(g.w-120, 10, 100, 3, (100, 100, 100))
-    _draw_bar(g.w-120, 10, int(100*g.hp/g.maxhp), 5, (255, 0, 0))
+    rects.append(_draw_bar(g.w-120, 10, 100, 3, (100, 100, 100)))
+    rects.append(_draw_bar(g.w-120, 10, int(100*g.hp/g.maxhp), 5, (255, 0, 0)))
 
   if g.active:
     for y in [30, 35, 40, 50, 55, 60]:
-      _draw_bar(g.w-100, y, 80, 2, (100, 100, 100))
-
-    _draw_bar(g.w-100, 30, int(80*g.active.red/255), 3, (200, 0, 0))
-    _draw_bar(g.w-100, 35, int(80*g.active.green/255), 3, (0, 200, 0))
-    _draw_bar(g.w-100, 40, int(80*g.active.blue/255), 3, (0, 0, 200))
-
-    _draw_bar(g.w-100, 50, int(80*g.active.yellow/255), 3, (200, 200, 0))
-    _draw_bar(g.w-100, 55, int(80*g.active.magenta/255), 3, (200, 0, 200))
-    _draw_bar(g.w-100, 60, int(80*g.active.cyan/255), 3, (0, 200, 200))
+      rects.append(_draw_bar(g.w-100, y, 80, 2, (100, 100, 100)))
+
+    rects.append(_draw_bar(g.w-100, 30, int(80*g.active.red/255), 3, (200, 0, 0)))
+    rects.append(_draw_bar(g.w-100, 35, int(80*g.active.green/255), 3, (0, 200, 0)))
+    rects.append(_draw_bar(g.w-100, 40, int(80*g.active.blue/255), 3, (0, 0, 200)))
+
+    rects.append(_draw_bar(g.w-100, 50, int(80*g.active.yellow/255), 3, (200, 200, 0)))
+    rects.append(_draw_bar(g.w-100, 55, int(80*g.active.magenta/255), 3, (200, 0, 200)))
+    rects.append(_draw_bar(g.w-100, 60, int(80*g.active.cyan/255), 3, (0, 200, 200)))
+
+    panel = r.panel('stats', g.font_small, g.active.stats, True)
+    rects.append(r.blit(panel, (g.w - 20 - panel.get_width(), 80)))
+
+  if detail.log:
+    panel = r.panel('log', g.font, [line for line in g.logged if line])
+    rects.append(r.blit(panel, (20, 0)))
+
+  text = r.text(g.font, str(g.score), (150, 150, 150))
+  rects.append(r.blit(text, (10, g.h-10-text.get_height())))
+  if g.fast_forward and g.fast_forward.chosen > 1:
+    x = 30 + text.get_width()
+    speed = "%dx" % g.fast_forward.speed
+    if g.fast_forward.speed < g.fast_forward.chosen:
+      speed += " (%dx)" % g.fast_forward.chosen
+    text = r.text(g.font, speed, (150, 150, 0))
+    rects.append(r.blit(text, (x, g.h-10-text.get_height())))
+
+  if g.timer and g.timer.overlay:
+    panel = r.panel('timer', g.font_small, g.timer.report(), True)
+    rects.append(r.blit(panel, (g.w - 10 - panel.get_width(),
+      g.h - 10 - panel.get_height())))
+
+  rects = [rect for rect in rects if rect]
+  if g.timer: g.timer.mark('draw')
+  if redraw or len(rects) + len(g.dirty) + len(moved) > g.max_dirty_rects:
+    update = None
+  else:
+    update = g.dirty + moved + rects
+  g.dirty = rects
+  g.drawn_shake = g.shake
+  g.redraw = False
+  if thread:
+    thread.end_draw()  # the simulation can go on while pygame presents
+  if update is None:
+    r.flip()
+  else:
+    r.update(update)
+  if g.timer: g.timer.mark('flip')
+  # the whole frame counts, drawing less makes up for slow simulation too
+  detail.update(sum(g.timer.current[:-1]) - fast_forward_time if g.timer else
+      default_timer() - time_before)
 
-    x, y = g.w - 20, 80
-    for line in g.active.stats:
-      text = g.font_small.render(line, 1, (255, 255, 255))
-      g.screen.blit(text, (x - text.get_rect().width, y))
-      y += text.get_rect().height + 2
 
-  x, y = 20, 0
-  for line in g.logged:
-    if not line:
-      continue
-    text = g.font.render(line, 1, (255, 255, 255))
-    g.screen.blit(text, (x, y))
-    y += text.get_rect().height + 2
+def _stamp_monsters():
+  """
+  Draw all monsters with one stamp() of the renderer per kind, without
+  rotating the crosses.  Returns the rects that were drawn on.
+  """
+  store = g.monster_store
+  if store is not None:
+    n = store.n
+    x, y, hp, maxhp, square, swarm, packed = [getattr(store, name)[:n] for
+        name in ('x', 'y', 'hp', 'maxhp', 'square', 'swarm', 'color')]
+    colors = numpy.column_stack((packed >> 16, packed >> 8 & 255, packed & 255))
+  else:
+    mobs = g.mobs
+    x, y, hp, maxhp = [numpy.array([getattr(mob, name) for mob in mobs],
+        float) for name in ('x', 'y', 'hp', 'maxhp')]
+    square, swarm = [numpy.array([getattr(mob, name) for mob in mobs], bool)
+        for name in ('square', 'swarm')]
+    colors = numpy.array([mob.original_color for mob in mobs], int)
+  # the same colors as Monster.color, darker the more damaged
+  colors = (colors * numpy.clip(hp / maxhp, 0, 1)[:, None]).astype(int)
+  x = (x + g.shake[0]).astype(int)
+  y = (y + g.shake[1]).astype(int)
+  white = (255, 255, 255)
+  r = g.renderer
+  rects = []
+  for kind, size, render, args in (
+      (~(square | swarm), 13, Monster._render_cross, (0, white)),
+      (square, 8, Monster._render_square, (white,)),
+      (swarm, 3, Monster._render_dot, (white,))):
+    if kind.any():
+      rects.append(r.stamp(x[kind] - size // 2, y[kind] - size // 2,
+        colors[kind], (render.__name__, white), render, *args))
+  return rects
+
+
+def _update_track():
+  """
+  Render the track again if its pulsing color or the path has changed.
+  Returns True if all of it was rendered, else the rects that were.
+  """
+  checkpoints = g.detail.checkpoints
+  if checkpoints:
+    pulse = int(round(24 * sin(g.game_time) / g.track_pulse_step))
+  else:
+    pulse = 0  # each change of the pulse redraws the whole screen
+  key = (g.path, tuple(g.level_color), pulse, checkpoints)
+  if key == g.track_key:
+    if g.track_points == g.checkpoints:
+      return []
+    moved, g.track_points = g.track_points, list(g.checkpoints)
+    return g.renderer.move_track(moved, g.track_points)
+  g.track_key = key
+  g.track_points = list(g.checkpoints)
+  pulse *= g.track_pulse_step
+  normal = [int(max(0, min(255, pulse + clr))) for clr in g.level_color]
+  dark = [int(clr*0.5) for clr in normal]
+  g.renderer.draw_track(g.track_points, dark, normal, checkpoints)
+  return True
 
-  line = str(g.score)
-  text = g.font.render(line, 1, (150, 150, 150))
-  g.screen.blit(text, (10, g.h-10-text.get_rect().height))
 
-  pygame.display.flip()
+def _restore_track(rect):
+  """Erase what was drawn in the rect, leaving only the track"""
+  g.renderer.fill((0, 0, 0), rect)
+  g.renderer.blit_track(rect.topleft, rect.move(-g.shake[0], -g.shake[1]))
 
 
 class Actor(object):
+  __slots__ = ()
+
   @property
   def pos(self):
     return int(self.x), int(self.y)
@@ -321,6 +1349,11 @@ class Actor(object):
 
 
 class Monster(Actor):
+  __slots__ = ('level', 'hp', 'maxhp', 'checkpoint', 'speed', 'danger', 'phase',
+      'armor', 'x', 'y', 'square', 'swarm', 'original_speed', 'original_color',
+      'original_armor')
+  pool = []  # dead monsters, to be recycled by spawn_monster()
+
   # Generate the rotating model of monster 1
   cross = [(-5,-1), (-1,-1), (-1,-5), (1,-5), (1,-1), (5,-1), (5,1), (1,1),
       (1,5), (-1,5), (-1,1), (-5,1)]
@@ -328,15 +1361,16 @@ class Monster(Actor):
   rotated_cross = [[(p[0] * sin(a) + p[1] * cos(a), -p[0] * cos(a) + p[1] * sin(a))
     for p in cross] for a in steps]
 
-  def __init__(self, level):
+  def __init__(self, level, swarm=False):
     self.level = level
     self.hp = 8 * level
     self.checkpoint = 0
-    self.speed = 1 + level * 0.1 + randint(-10,10) * 0.04
+    self.speed = 1 + level * 0.1 + g.rng.randint(-10,10) * 0.04
     self.danger = 0
     self.phase = 0
     self.armor = max(0, (level - 5)/2)
-    self.color = (randint(1,3) * 63, randint(1,3) * 63, randint(1,3) * 63)
+    self.original_color = (g.rng.randint(1,3) * 63, g.rng.randint(1,3) * 63,
+        g.rng.randint(1,3) * 63)
     self.x, self.y = g.checkpoints[self.checkpoint]
     if level % 3 == 0:
       self.square = True
@@ -345,139 +1379,463 @@ class Monster(Actor):
       self.speed *= 0.8
     else:
       self.square = False
+    # a small monster of a swarm, which counts as a fraction of one
+    self.swarm = swarm
+    if swarm:
+      self.square = False
+      self.armor = 0
+      self.hp = 8 * level * g.swarm_weight
 
     self.maxhp = float(self.hp)
     self.original_speed = self.speed
-    self.original_color = self.color
     self.original_armor = self.armor
 
+  @property
+  def color(self):
+    """The color of the monster, darker the more it is damaged"""
+    ratio = self.hp / self.maxhp
+    return tuple(max(0, min(255, int(c * ratio))) for c in self.original_color)
+
   def walk(self):
+    # The danger of a monster is the distance it has travelled on the path
     self.phase = (self.phase + 30 * g.dt * tau / len(self.steps)) % tau
-    point1 = g.checkpoints[self.checkpoint]
-    point2 = g.checkpoints[self.checkpoint + 1]
-    angle = atan2(point2[1] - point1[1], point2[0] - point1[0])
-    step = self.speed * g.dt * 30
-    self.x += cos(angle) * step
-    self.y += sin(angle) * step
-    self.danger += self.speed * g.dt
-    if abs(point2[0] - self.x) < step * 2 and \
-        abs(point2[1] - self.y) < step * 2:
-      if self.checkpoint >= len(g.checkpoints) - 2:
-        self.hp = 0
-        if g.hp > 0:
-          g.hp -= g.hp_damage
-          g.shake_until = max(g.shake_until, g.game_time + 2.0)
-          if g.hp <= 0:
-            g.lose()
-      else:
-        self.checkpoint += 1
-        self.x, self.y = g.checkpoints[self.checkpoint]
+    self.danger += self.speed * g.dt * 30
+    path = g.path
+    if self.danger >= path.length:
+      self.hp = 0
+      _monster_leaked(g.swarm_weight if self.swarm else 1)
+      return
+    i = self.checkpoint
+    while path.start[i + 1] <= self.danger:
+      i += 1
+    self.checkpoint = i
+    offset = self.danger - path.start[i]
+    self.x = path.points[i][0] + path.ux[i] * offset
+    self.y = path.points[i][1] + path.uy[i] * offset
 
   def draw(self):
     x, y = int(self.x + g.shake[0]), int(self.y + g.shake[1])
-    if self.square:
-      pygame.draw.rect(g.screen, self.color, Rect(x-4, y-4, 8, 8), 3)
+    color = _quantize_color(self.color)
+    if self.swarm:
+      sprite = g.renderer.sprite(('dot', color), self._render_dot, color)
+      return g.renderer.blit(sprite, (x-1, y-1))
+    elif self.square:
+      sprite = g.renderer.sprite(('square', color), self._render_square, color)
+      return g.renderer.blit(sprite, (x-4, y-4))
     else:
-      pygame.draw.polygon(g.screen, self.color, [(x+p, y+q) for p, q in
-        self.rotated_cross[int(self.phase / tau * len(self.steps))]], 1)
-
-  def damage(self, damage, tower):
-    damage = max(0, damage - self.armor * (1 - tower.armor_pierce))
-    self.hp -= damage
-    self.color = [max(0, min(255, int(c * self.hp / self.maxhp))) for c in self.original_color]
-    self.speed -= tower.freeze * self.original_speed
-    self.speed = min(self.original_speed, max(self.original_speed *
-      g.monster_min_speed, self.speed))
-    if tower.armor_decay:
-      self.armor -= tower.armor_decay
-      self.armor = min(self.original_armor, max(self.original_armor *
-        g.monster_min_armor, self.armor))
-    if self.hp <= 0 and -self.hp <= damage:
-      return True
-    return False
+      if g.detail.rotation:
+        phase = int(self.phase / tau * len(self.steps)) % len(self.steps)
+      else:
+        phase = 0
+      sprite = g.renderer.sprite(('cross', phase, color), self._render_cross,
+          phase, color)
+      return g.renderer.blit(sprite, (x-6, y-6))
+
+  @staticmethod
+  def _render_dot(color):
+    surface = _sprite_surface(3, 3)
+    surface.fill(color)
+    return surface
+
+  @staticmethod
+  def _render_square(color):
+    surface = _sprite_surface(8, 8)
+    pygame.draw.rect(surface, color, Rect(0, 0, 8, 8), 3)
+    return surface
+
+  @classmethod
+  def _render_cross(cls, phase, color):
+    surface = _sprite_surface(13, 13)
+    pygame.draw.polygon(surface, color, [(6+p, 6+q) for p, q in
+      cls.rotated_cross[phase]], 1)
+    return surface
+
+  def slow(self, freeze, armor_decay):
+    """Apply the accumulated freeze and armor decay of a tick"""
+    original = self.original_speed
+    self.speed = min(original, max(original * g.monster_min_speed,
+      self.speed - freeze * original))
+    if armor_decay:
+      original = self.original_armor
+      self.armor = min(original, max(original * g.monster_min_armor,
+        self.armor - armor_decay))
+
+
+def _stored(name):
+  """A property that reads and writes one row of g.monster_store"""
+  def get(self):
+    return getattr(g.monster_store, name).item(self.index)
+  def set(self, value):
+    getattr(g.monster_store, name)[self.index] = value
+  return property(get, set)
+
+
+class StoredMonster(Monster):
+  """A Monster whose state lives in a row of g.monster_store"""
+  __slots__ = ('index',)
+  pool = []
+
+  x = _stored('x')
+  y = _stored('y')
+  speed = _stored('speed')
+  hp = _stored('hp')
+  armor = _stored('armor')
+  danger = _stored('danger')
+  phase = _stored('phase')
+  checkpoint = _stored('checkpoint')
+  original_speed = _stored('original_speed')
+  original_armor = _stored('original_armor')
+  maxhp = _stored('maxhp')
+  square = _stored('square')
+  swarm = _stored('swarm')
+
+  def __init__(self, level, swarm=False):
+    g.monster_store.add(self)
+    Monster.__init__(self, level, swarm)
+
+  @property
+  def original_color(self):
+    rgb = g.monster_store.color.item(self.index)
+    return (rgb >> 16, rgb >> 8 & 255, rgb & 255)
+
+  @original_color.setter
+  def original_color(self, color):
+    g.monster_store.color[self.index] = color[0] << 16 | color[1] << 8 | color[2]
+
+  def walk(self):
+    pass  # moved in bulk by MonsterStore.walk()
+
+
+class MonsterStore(object):
+  """
+  The monster state that changes every tick, as numpy arrays in the order
+  of g.mobs.
+  """
+  fields = ('x', 'y', 'speed', 'hp', 'armor', 'danger', 'phase', 'checkpoint',
+      'original_speed', 'original_armor', 'freeze', 'armor_decay', 'maxhp',
+      'color', 'square', 'swarm')
+  types = {'checkpoint': int, 'color': int, 'square': bool, 'swarm': bool}
+
+  def __init__(self, capacity=256):
+    self.n = 0
+    self.capacity = capacity
+    self.slowed = False
+    for name in self.fields:
+      setattr(self, name, numpy.zeros(capacity, self.types.get(name, float)))
+
+  def add(self, mob):
+    if self.n == self.capacity:
+      self.capacity *= 2
+      for name in self.fields:
+        array = getattr(self, name)
+        grown = numpy.zeros(self.capacity, array.dtype)
+        grown[:self.n] = array
+        setattr(self, name, grown)
+    mob.index = self.n
+    self.n += 1
+    g.mobs.append(mob)
+
+  def compact(self):
+    """Remove the rows of dead monsters, preserving the order"""
+    n = self.n
+    alive = self.hp[:n] > 0
+    if alive.all():
+      return
+    for name in self.fields:
+      array = getattr(self, name)
+      kept = array[:n][alive]
+      array[:len(kept)] = kept
+    mobs, dead = [], []
+    for mob, keep in zip(g.mobs, alive.tolist()):
+      (mobs if keep else dead).append(mob)
+    _recycle(dead)
+    g.mobs = mobs
+    first = int(alive.argmin())  # the rows before the first dead one stay
+    for i in range(first, len(mobs)):
+      mobs[i].index = i
+    self.n = len(g.mobs)
+
+  def walk(self):
+    """The equivalent of Monster.walk() for every stored monster"""
+    n = self.n
+    if n == 0:
+      return
+    points, ux, uy, start = g.path.arrays()
+    phase = self.phase[:n]
+    phase += 30 * g.dt * tau / len(Monster.steps)
+    phase %= tau
+    danger = self.danger[:n]
+    danger += self.speed[:n] * (g.dt * 30)
+
+    leaked = danger >= g.path.length
+    if leaked.any():
+      self.hp[:n][leaked] = 0
+      for swarm in self.swarm[:n][leaked].tolist():
+        _monster_leaked(g.swarm_weight if swarm else 1)
+    i = numpy.searchsorted(start, danger, 'right') - 1
+    # the segment of every monster, which is also its checkpoint now
+    i = numpy.minimum(i, len(ux) - 1, out=self.checkpoint[:n])
+    offset = danger - start[i]
+    self.x[:n] = points[i, 0] + ux[i] * offset
+    self.y[:n] = points[i, 1] + uy[i] * offset
+
+  def _mask_in_range(self, r, x, y):
+    n = self.n
+    dx = self.x[:n] - x
+    dy = self.y[:n] - y
+    return (self.hp[:n] > 0) & (dx * dx + dy * dy < r * r)
+
+  def in_range(self, r, x, y):
+    """The living monsters within distance r of (x, y)"""
+    mobs = g.mobs
+    return [mobs[i] for i in numpy.flatnonzero(self._mask_in_range(r, x, y))]
+
+  def most_dangerous(self, r, x, y):
+    """The monster with the highest danger within distance r of (x, y)"""
+    indices = numpy.flatnonzero(self._mask_in_range(r, x, y))
+    if not len(indices):
+      return None
+    return g.mobs[indices[self.danger[indices].argmax()]]
+
+  def hit(self, tower, x, y):
+    """
+    Damage the monsters in splash range of (x, y) and return how many died,
+    swarm monsters as fractions, and the sum of their levels.
+    """
+    indices = numpy.flatnonzero(self._mask_in_range(tower.radius, x, y))
+    if not len(indices):
+      return 0, 0
+    damage = tower.damage + tower.bonus_damage
+    dealt = numpy.maximum(0, damage - self.armor[indices] * (1 - tower.armor_pierce))
+    hp = self.hp[indices] - dealt
+    self.hp[indices] = hp
+    self.freeze[indices] += tower.freeze
+    self.armor_decay[indices] += tower.armor_decay
+    self.slowed = True
+    killed = indices[hp <= 0]
+    kills = len(killed)
+    swarm = int(self.swarm[killed].sum())
+    if swarm:
+      kills -= swarm * (1 - g.swarm_weight)
+    return kills, sum(g.mobs[i].level for i in killed)
+
+  def slow(self):
+    """The equivalent of Monster.slow() for every monster that was hit"""
+    if not self.slowed:
+      return
+    self.slowed = False
+    n = self.n
+    freeze, armor_decay = self.freeze[:n], self.armor_decay[:n]
+    original = self.original_speed[:n]
+    speed = self.speed[:n]
+    speed -= freeze * original
+    numpy.clip(speed, original * g.monster_min_speed, original, speed)
+    if armor_decay.any():
+      original = self.original_armor[:n]
+      armor = self.armor[:n]
+      armor -= armor_decay
+      numpy.clip(armor, original * g.monster_min_armor, original, armor)
+    freeze[:] = 0
+    armor_decay[:] = 0
+
+
+def spawn_monster(level, swarm=False):
+  """
+  Create a monster of the given level and add it to g.mobs.  Dead monsters
+  are recycled to avoid allocating new objects for every wave.
+  """
+  cls = StoredMonster if g.monster_store is not None else Monster
+  mob = cls.pool.pop() if cls.pool else cls.__new__(cls)
+  mob.__init__(level, swarm)
+  if cls is Monster:
+    g.mobs.append(mob)
+
+
+def _recycle(mobs):
+  """Put dead monsters into the pool of their class"""
+  for mob in mobs:
+    if len(mob.pool) < g.monster_pool_size:
+      mob.pool.append(mob)
+
+
+def _monster_leaked(weight=1):
+  """A monster reached the end of the track"""
+  if g.hp > 0:
+    g.hp -= g.hp_damage * weight
+    g.shake_until = max(g.shake_until, g.game_time + 2.0)
+    if g.hp <= 0:
+      g.lose()
+
+
+class Path(object):
+  """
+  The geometry of the track: the unit vectors and lengths of its segments
+  and the arc lengths at which they start.
+  """
+  def __init__(self, points):
+    self.points = [(float(x), float(y)) for x, y in points]
+    self.ux, self.uy, self.lengths, self.start = [], [], [], [0.0]
+    for i in range(len(self.points) - 1):
+      self.ux.append(0.0)
+      self.uy.append(0.0)
+      self.lengths.append(0.0)
+      self.start.append(0.0)
+      self._update_segment(i)
+      self.start[i + 1] = self.start[i] + self.lengths[i]
+    self.length = self.start[-1]
+    self._arrays = None
+
+  def _update_segment(self, i):
+    (x1, y1), (x2, y2) = self.points[i], self.points[i + 1]
+    length = sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+    self.ux[i] = (x2 - x1) / length if length else 0.0
+    self.uy[i] = (y2 - y1) / length if length else 0.0
+    self.lengths[i] = length
+
+  def move(self, points):
+    """
+    Move the checkpoints to the given places.  Returns the arc lengths and
+    segment lengths from before, or None if nothing moved.
+    """
+    moved = [i for i, (old, new) in enumerate(zip(self.points, points))
+        if old != new]
+    if not moved:
+      return None
+    old_start, old_lengths = self.start[:], self.lengths[:]
+    for i in moved:
+      self.points[i] = (float(points[i][0]), float(points[i][1]))
+    segments = sorted(set(i for m in moved for i in (m - 1, m)
+        if 0 <= i < len(self.lengths)))
+    for i in segments:
+      self._update_segment(i)
+    start = self.start
+    for i in range(segments[0], len(self.lengths)):
+      start[i + 1] = start[i] + self.lengths[i]
+    self.length = start[-1]
+    if self._arrays is not None:
+      array_points, ux, uy, array_start = self._arrays
+      array_points[moved] = [self.points[i] for i in moved]
+      ux[segments] = [self.ux[i] for i in segments]
+      uy[segments] = [self.uy[i] for i in segments]
+      array_start[segments[0]:] = start[segments[0]:]
+    return old_start, old_lengths
+
+  def arrays(self):
+    """The same data as numpy arrays (points, ux, uy, start)"""
+    if self._arrays is None:
+      self._arrays = (numpy.array(self.points), numpy.array(self.ux),
+          numpy.array(self.uy), numpy.array(self.start))
+    return self._arrays
 
 
 class Tower(Actor):
+  __slots__ = ('red', 'green', 'blue', 'color', 'size', 'x', 'y', 'vx', 'vy',
+      'last_shot', 'ready', 'ready_event', 'phase', 'bonus_damage',
+      'stats_size', 'target_point', '_stats',
+      'yellow', 'cyan', 'magenta', 'damage', 'armor_decay', 'freeze',
+      'armor_pierce', 'support', 'radius', 'range', 'shot_delay', 'pinhead',
+      'inertia', 'dps')
   starting_towers = [(60, 0, 0), (0, 60, 0), (0, 0, 60)]
   def __init__(self):
     if g.towers:
-      self.color = choice(self.starting_towers)
+      self.color = g.rng.choice(self.starting_towers)
     else:
       self.color = self.starting_towers[0]
     self.red, self.green, self.blue = self.color
     self.size = 0
     self.x = g.w
     self.y = g.h * 0.5
-    self.vx = randint(-100, -40)
-    self.vy = randint(-100, 100)
+    self.vx = g.rng.randint(-100, -40)
+    self.vy = g.rng.randint(-100, 100)
     self.last_shot = 0
+    self.ready = False
+    self.ready_event = None
+    self.shot_delay = None
     self.range = 100
     self.phase = 0
     self.bonus_damage = 0
-    self.stats = []
+    self._stats = None
     self.target_point = None
     self.update_stats()
 
-  def update_stats(self):
-    r, g, b = self.red, self.green, self.blue
-    self.yellow = max(0, (r + g) / 2 - b - abs(r - g))
-    self.cyan = max(0, (b + g) / 2 - r - abs(b - g))
-    self.magenta = max(0, (b + r) / 2 - g - abs(b - r))
+  def update_stats(self, stats_size=None):
+    """
+    Derive the properties of the bubble from its color and size, memoized
+    per g.stats_size_step of size.
+    """
+    if stats_size is None:
+      stats_size = int(round(self.size / g.stats_size_step))
+    self.stats_size = stats_size
+    key = (self.red, self.green, self.blue, stats_size, self.bonus_damage)
+    derived = _tower_stats.get(key)
+    if derived is None:
+      if len(_tower_stats) >= g.stats_cache_size:
+        _tower_stats.clear()
+      derived = _tower_stats[key] = _derive_tower_stats(key[0], key[1],
+          key[2], key[3] * g.stats_size_step, key[4])
+    shot_delay = self.shot_delay
+    (self.yellow, self.cyan, self.magenta, self.damage, self.armor_decay,
+        self.freeze, self.armor_pierce, self.support, self.radius, self.range,
+        self.shot_delay, self.pinhead, self.inertia, self.dps) = derived
+    self.color = key[:3]
+    self._stats = None
+    if self.shot_delay != shot_delay:
+      self.reload()
+
+  def reload(self):
+    """Schedule when the bubble can shoot again"""
+    if self.ready_event:
+      g.events.cancel(self.ready_event)
+    self.ready = False
+    self.ready_event = g.events.at(self.last_shot + self.shot_delay,
+        self._get_ready)
+
+  def _get_ready(self):
+    self.ready = True
+    self.ready_event = None
 
+  @property
+  def stats(self):
+    """The human readable stats, only generated when they are shown"""
+    if self._stats is not None:
+      return self._stats
+    self._stats = stats = []
     size_damage = 1 + self.size / 10.0
-    red_damage = r / 16.0
-    self.damage = size_damage + red_damage
-
-    self.color = (r, g, b)
-    self.armor_decay = sqrt(self.cyan / 2048.0)
-    self.freeze = b / 2048.0
-    self.armor_pierce = 0
-    self.support = 0
-    if self.magenta > 0:
-      self.support = self.size / 20.0 + self.magenta / 16.0
-    self.radius = int(sqrt((50 + self.size * 1.5) * pi))
-    self.range = int(self.radius + 30 + sqrt(g * 10) * 2)
-
-    self.shot_delay = max(0.1, 0.4 - (0.3 * self.yellow / 255.0) \
-        + (self.size / 10000.0))
-    if self.yellow == 0 and self.magenta == 0 and self.cyan == 0:
-      self.shot_delay = 1 / (1 / (self.shot_delay) + 2)
-    self.pinhead = 21 if all(color in range(76, 128) for color in self.color) else 1
-    self.inertia = 4.0 / (4 + self.size * self.pinhead / 100.0)
-    if self.color == (0, 0, 0):
-      self.armor_pierce = 1
-
-    self.dps = 1 / self.shot_delay * (self.damage + self.bonus_damage)
-
-    self.stats = []
-    self.stats.append("DPS: %.2f" % self.dps)
-    self.stats.append("damage: %d + %d + %d" % (size_damage, red_damage,
+    red_damage = self.red / 16.0
+    stats.append("DPS: %.2f" % self.dps)
+    stats.append("damage: %d + %d + %d" % (size_damage, red_damage,
       self.bonus_damage))
-    self.stats.append("range: %d" % self.range)
-    self.stats.append("attacks per second: %.2f" % (1 / self.shot_delay))
-    self.stats.append("")
+    stats.append("range: %d" % self.range)
+    stats.append("attacks per second: %.2f" % (1 / self.shot_delay))
+    stats.append("")
     if self.yellow > 0:
-      self.stats.append("yellow: +%.2f attacks/second" % \
+      stats.append("yellow: +%.2f attacks/second" % \
           (1 / self.shot_delay - 1 / max(0.1, 0.4 + (self.size / 10000.0))))
     if self.freeze > 0:
-      self.stats.append("blue: %.3f freeze" % self.freeze)
+      stats.append("blue: %.3f freeze" % self.freeze)
     if self.armor_decay > 0:
-      self.stats.append("cyan: %.2f armor breaking" % self.armor_decay)
+      stats.append("cyan: %.2f armor breaking" % self.armor_decay)
     if self.magenta > 0:
-      self.stats.append("magenta: +%d damage to bubbles in range" % self.support)
+      stats.append("magenta: +%d damage to bubbles in range" % self.support)
     if self.color == (0, 0, 0):
-      self.stats.append("black hole bonus: armor piercing")
+      stats.append("black hole bonus: armor piercing")
     if self.pinhead > 1:
-      self.stats.append("pin head bonus: inertia x20")
+      stats.append("pin head bonus: inertia x20")
     if self.yellow == 0 and self.magenta == 0 and self.cyan == 0:
-      self.stats.append("purity bonus: +2 attacks/second")
-    self.stats.append("")
-    self.stats.append("power level: %d" % self.size)
-    self.stats.append("radius: %d" % self.radius)
+      stats.append("purity bonus: +2 attacks/second")
+    stats.append("")
+    stats.append("power level: %d" % self.size)
+    stats.append("radius: %d" % self.radius)
+    return stats
 
   def walk(self):
+    self.move()
+    if self.ready:
+      self.shoot()
+
+  def move(self):
     if g.drag == self:
-      mouse = pygame.mouse.get_pos()
+      mouse = g.mouse
       if self.distance(mouse[0], mouse[1]) < g.max_drag_dist:
         xtarget, ytarget = mouse
       else:
@@ -504,173 +1862,1522 @@ class Tower(Actor):
         self.y + self.radius > g.h and self.vy > 0:
       self.vy *= -1
 
-    if self.last_shot + self.shot_delay < g.game_time:
-      self.shoot()
-
-    if self.support > 0:
-      for tower in g.towers:
-        if tower != self and tower.distance(self.x, self.y) < self.range \
-            and tower.bonus_damage < self.support:
-          tower.bonus_damage = self.support
-          tower.update_stats()
-
   def draw(self):
-    width  = (1 - 0.2 * sin(self.phase+0.2)) * self.radius * 2
-    height = (1 + 0.2 * sin(self.phase)) * self.radius * 2
-    x = int(self.x - width / 2)
-    y = int(self.y - height / 2)
-    rect = Rect(x - 1, y - 1, width + 2, height + 2)
-    pygame.draw.ellipse(g.screen, (20, 20, 20), rect, 0)
-    rect = Rect(x, y, width, height)
-    pygame.draw.ellipse(g.screen, self.color, rect, 0)
+    phase = int(self.phase / tau * 24) % 24 if g.detail.rotation else 0
+    r = g.renderer
+    sprite = r.sprite(('bubble', self.radius, phase, self.color),
+        self._render_bubble, self.radius, phase, self.color)
+    width, height = sprite.get_size()
+    rect = r.blit(sprite, (int(self.x - width / 2), int(self.y - height / 2)))
     if self.target_point:
-      pygame.draw.circle(g.screen, self.color, self.target_point, self.radius, 0)
-      pygame.draw.line(g.screen, self.color, self.pos, self.target_point, self.radius)
+      if g.detail.beams:
+        rect.union_ip(r.circle(self.color, self.target_point, self.radius, 0))
+        rect.union_ip(r.line(self.color, self.pos, self.target_point,
+          self.radius))
       self.target_point = None
+    return rect
+
+  @staticmethod
+  def _render_bubble(radius, phase, color):
+    phase = phase * tau / 24
+    width = int((1 - 0.2 * sin(phase+0.2)) * radius * 2)
+    height = int((1 + 0.2 * sin(phase)) * radius * 2)
+    surface = _sprite_surface(width + 2, height + 2)
+    pygame.draw.ellipse(surface, (20, 20, 20), Rect(0, 0, width + 2, height + 2), 0)
+    pygame.draw.ellipse(surface, color, Rect(1, 1, width, height), 0)
+    return surface
 
   def _get_monsters_in_range(self, r, x, y):
-    for mob in g.mobs:
+    if g.monster_store is not None:
+      for mob in g.monster_store.in_range(r, x, y):
+        yield mob
+      return
+    for mob in g.mob_grid.query(r, x, y):
       if mob.hp > 0 and abs(mob.x - x) < r and abs(mob.y - y) < r and \
           mob.distance(x, y) < r:
         yield mob
 
+  def _get_target(self):
+    """The most dangerous monster in range"""
+    x, y, r = self.x, self.y, self.range
+    if g.monster_store is not None:
+      return g.monster_store.most_dangerous(r, x, y)
+    best = None
+    for cell in g.mob_grid.cells_near(r, x, y):
+      # the cells are ordered by danger, so the first hit is the best one
+      for mob in cell:
+        if mob.hp > 0 and abs(mob.x - x) < r and abs(mob.y - y) < r and \
+            mob.distance(x, y) < r:
+          if best is None or mob.danger > best.danger:
+            best = mob
+          break
+    return best
+
   def shoot(self):
-    mobs = list(self._get_monsters_in_range(self.range, self.x, self.y))
-    if not mobs:
+    target = self._get_target()
+    if target is None:
       return
     self.size += g.growth_per_shot
     self.last_shot = g.game_time
-    target = max(mobs, key=lambda mob: mob.danger)
+    self.reload()
 
     self.target_point = target.pos
+    self._hit(target)
+
+  def _hit(self, target):
+    """Damage the monsters within the splash radius around the target"""
+    g.damage_batch.hit(self, target.x, target.y)
+
+
+class DamageBatch(object):
+  """
+  Collects the effects of the shots in a tick, for resolve() to apply once
+  per monster and bubble.  Hit points are taken right away.
+  """
+  def __init__(self):
+    self.slowed = {}  # monster -> [freeze, armor decay]
+    self.kills = {}  # bubble -> number of monsters it killed
+    self.score = 0
+
+  def hit(self, tower, x, y):
+    if g.monster_store is not None:
+      kills, score = g.monster_store.hit(tower, x, y)
+    else:
+      damage = tower.damage + tower.bonus_damage
+      pierce = 1 - tower.armor_pierce
+      freeze, armor_decay = tower.freeze, tower.armor_decay
+      slowed = self.slowed
+      kills = score = 0
+      for mob in tower._get_monsters_in_range(tower.radius, x, y):
+        mob.hp -= max(0, damage - mob.armor * pierce)
+        if mob.hp <= 0:
+          kills += g.swarm_weight if mob.swarm else 1
+          score += mob.level
+        effect = slowed.get(mob)
+        if effect is None:
+          slowed[mob] = [freeze, armor_decay]
+        else:
+          effect[0] += freeze
+          effect[1] += armor_decay
+    if kills:
+      self.kills[tower] = self.kills.get(tower, 0) + kills
+      self.score += score
+
+  def resolve(self):
+    if g.monster_store is not None:
+      g.monster_store.slow()
+    for mob, (freeze, armor_decay) in self.slowed.items():
+      mob.slow(freeze, armor_decay)
+    kills = 0
+    for tower, count in self.kills.items():
+      tower.size += count * g.growth_per_kill
+      tower.update_stats()
+      kills += count
+    if kills:
+      g.hp = min(g.maxhp, g.hp + kills * g.hp_per_monster)
+      g.score += self.score
+    self.slowed.clear()
+    self.kills.clear()
+    self.score = 0
+
+
+_tower_stats = {}
+
+
+def _derive_tower_stats(r, g, b, size, bonus_damage):
+  """The properties of a bubble with the given color, size and bonus"""
+  yellow = max(0, (r + g) / 2 - b - abs(r - g))
+  cyan = max(0, (b + g) / 2 - r - abs(b - g))
+  magenta = max(0, (b + r) / 2 - g - abs(b - r))
+
+  damage = 1 + size / 10.0 + r / 16.0
+  armor_decay = sqrt(cyan / 2048.0)
+  freeze = b / 2048.0
+  armor_pierce = 1 if (r, g, b) == (0, 0, 0) else 0
+  support = 0
+  if magenta > 0:
+    support = size / 20.0 + magenta / 16.0
+  radius = int(sqrt((50 + size * 1.5) * pi))
+  range_ = int(radius + 30 + sqrt(g * 10) * 2)
+
+  shot_delay = max(0.1, 0.4 - (0.3 * yellow / 255.0) + (size / 10000.0))
+  if yellow == 0 and magenta == 0 and cyan == 0:
+    shot_delay = 1 / (1 / (shot_delay) + 2)
+  pinhead = 21 if all(color in range(76, 128) for color in (r, g, b)) else 1
+  inertia = 4.0 / (4 + size * pinhead / 100.0)
+  dps = 1 / shot_delay * (damage + bonus_damage)
+  return (yellow, cyan, magenta, damage, armor_decay, freeze, armor_pierce,
+      support, radius, range_, shot_delay, pinhead, inertia, dps)
+
+
+class SpatialGrid(object):
+  """
+  A uniform grid over actors for range queries, rebuild() it after they
+  have moved.
+  """
+  def __init__(self, cell_size):
+    self.cell_size = cell_size
+    self.cells = {}
+
+  def rebuild(self, actors):
+    """Bucket the actors by position"""
+    cells = self.cells = {}
+    size = self.cell_size
+    for actor in actors:
+      key = (int(actor.x // size), int(actor.y // size))
+      cell = cells.get(key)
+      if cell is None:
+        cells[key] = [actor]
+      else:
+        cell.append(actor)
+
+  def cells_near(self, r, x, y):
+    """Yield the non-empty cells overlapping the square of radius r"""
+    size = self.cell_size
+    cells = self.cells
+    x1, x2 = int((x - r) // size), int((x + r) // size)
+    y1, y2 = int((y - r) // size), int((y + r) // size)
+    for cx in range(x1, x2 + 1):
+      for cy in range(y1, y2 + 1):
+        cell = cells.get((cx, cy))
+        if cell:
+          yield cell
+
+  def query(self, r, x, y):
+    """
+    Yield the actors in the cells overlapping the square of radius r around
+    (x, y).  Callers still have to check the exact distance.
+    """
+    for cell in self.cells_near(r, x, y):
+      for actor in cell:
+        yield actor
+
+
+class SurfaceCache(object):
+  """
+  Pre-rendered surfaces, of which the least recently used are dropped
+  beyond max_bytes
+  """
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.uses = 0
+    self.surfaces = {}
+
+  def get(self, key, render, *args):
+    """Return the surface for key, creating it with render(*args)"""
+    self.uses += 1
+    entry = self.surfaces.get(key)
+    if entry is None:
+      surface = render(*args)
+      if pygame.display.get_surface() is not None:
+        if surface.get_flags() & SRCALPHA:
+          surface = surface.convert_alpha()
+        else:
+          surface = surface.convert()
+      entry = self.surfaces[key] = [surface, 0, _surface_bytes(surface)]
+      self.bytes += entry[2]
+      if self.bytes > self.max_bytes:
+        self._evict(self.max_bytes * 3 // 4)
+    entry[1] = self.uses
+    return entry[0]
+
+  def _evict(self, max_bytes):
+    for key, entry in sorted(self.surfaces.items(), key=lambda item: item[1][1]):
+      if self.bytes <= max_bytes:
+        break
+      del self.surfaces[key]
+      self.bytes -= entry[2]
+
+  def clear(self):
+    self.surfaces.clear()
+    self.bytes = 0
+
+
+class PygameRenderer(object):
+  """
+  Draws on the pygame display, with the pygame functions bound to the
+  screen as its drawing primitives
+  """
+  def open(self):
+    _import_pygame()
+    pygame.init()
+    pygame.font.init()
+    pygame.key.set_repeat(180, 80)
+    flags = DOUBLEBUF | (g.fullscreen and FULLSCREEN)
+    self.screen = screen = pygame.display.set_mode((g.w, g.h), flags, 32)
+    g.font_small = pygame.font.Font(g.font_name, g.font_size[0])
+    g.font = pygame.font.Font(g.font_name, g.font_size[1])
+    g.clock = pygame.time.Clock()
+    self.sprites = SurfaceCache(g.sprite_cache_bytes)
+    self.texts = SurfaceCache(g.text_cache_bytes)
+    self.panels = {}
+    self.shapes = {}  # sprite key: (sprite, pixels of it)
+    self.track = pygame.Surface((g.w, g.h)).convert()
+    self.track.set_colorkey((0, 0, 0), RLEACCEL)
+    self.track_scratch = pygame.Surface((g.w, g.h)).convert()
+
+    self.fill = screen.fill
+    self.blit = screen.blit
+    self.circle = partial(pygame.draw.circle, screen)
+    self.line = partial(pygame.draw.line, screen)
+    self.flip = pygame.display.flip
+    self.update = pygame.display.update
+
+  def sprite(self, key, render, *args):
+    """The surface for key, created with render(*args) if it's not cached"""
+    return self.sprites.get(key, render, *args)
+
+  def text(self, font, line, color=(255, 255, 255)):
+    """Render a line of text, or get it from the cache if it was before"""
+    return self.texts.get((font, line, color), font.render, line, 1, color)
+
+  def panel(self, name, font, lines, align_right=False):
+    """
+    A surface with the given lines of text below each other.  The panel with
+    this name is only composed again when the lines have changed.
+    """
+    lines = tuple(lines)
+    cached = self.panels.get(name)
+    if cached and cached[0] == (font, lines):
+      return cached[1]
+    texts = [self.text(font, line) for line in lines]
+    width = max([text.get_width() for text in texts] + [1])
+    height = max(1, sum(text.get_height() + 2 for text in texts))
+    panel = pygame.Surface((width, height), SRCALPHA)
+    y = 0
+    for text in texts:
+      x = width - text.get_width() if align_right else 0
+      panel.blit(text, (x, y), special_flags=BLEND_RGBA_MAX)
+      y += text.get_height() + 2
+    self.panels[name] = ((font, lines), panel)
+    return panel
+
+  def stamp(self, x, y, colors, key, render, *args):
+    """
+    Draw the opaque pixels of the sprite for key at every position in x and
+    y, each in its own color.  Returns the rect around them.
+    """
+    sprite = self.sprite(key, render, *args)
+    cached = self.shapes.get(key)
+    if cached is None or cached[0] is not sprite:  # new or re-rendered
+      cached = self.shapes[key] = (sprite,
+          numpy.nonzero(pygame.surfarray.array_colorkey(sprite)))
+    dx, dy = cached[1]
+    screen = self.screen
+    width, height = screen.get_size()
+    x = (x[:, None] + dx).ravel()
+    y = (y[:, None] + dy).ravel()
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    if not inside.any():
+      return Rect(0, 0, 0, 0)
+    shifts, losses = screen.get_shifts(), screen.get_losses()
+    mapped = 0
+    for i in range(3):
+      mapped = mapped | (colors[:, i] >> losses[i]) << shifts[i]
+    x, y = x[inside], y[inside]
+    pixels = pygame.surfarray.pixels2d(screen)
+    pixels[x, y] = numpy.repeat(mapped, len(dx))[inside]
+    del pixels  # unlocks the screen
+    left, top = x.min(), y.min()
+    return Rect(left, top, x.max() - left + 1, y.max() - top + 1)
+
+  def draw_track(self, points, dark, normal, dots):
+    """Render the track onto the track layer, transparent elsewhere"""
+    self.track_style = dark, normal, dots
+    track = self.track
+    track.fill((0, 0, 0))
+    pygame.draw.lines(track, dark, False, points, 10)
+    pygame.draw.lines(track, normal, False, points, 2)
+    for dot in points if dots else ():
+      pygame.draw.circle(track, dark, (dot[0], dot[1] + 1), 8, 0)
+      pygame.draw.circle(track, normal, (dot[0], dot[1] + 1), 8, 1)
+
+  def move_track(self, old, points):
+    """
+    Render the track again around the checkpoints that moved from their
+    places in old, the points drawn last.  Returns the rects.
+    """
+    dark, normal, dots = self.track_style
+    areas = []
+    for i, point in enumerate(points):
+      if point == old[i]:
+        continue
+      near = old[max(0, i - 1):i + 2] + points[max(0, i - 1):i + 2]
+      area = _bounding_rect(near).inflate(28, 28).clip(self.track.get_rect())
+      index = area.collidelist(areas)
+      while index != -1:
+        area.union_ip(areas.pop(index))
+        index = area.collidelist(areas)
+      areas.append(area)
+    runs = []
+    for i in range(len(points) - 1):
+      if _bounding_rect(points[i:i + 2]).inflate(20, 20).collidelist(areas) != -1:
+        if runs and runs[-1][-1] == i:
+          runs[-1].append(i + 1)
+        else:
+          runs.append([i, i + 1])
+    # drawn whole on a scratch layer and copied from there, since pygame
+    # draws clipped lines differently
+    scratch = self.track_scratch
+    scratch.fill((0, 0, 0))
+    for color, width in ((dark, 10), (normal, 2)):
+      for run in runs:
+        pygame.draw.lines(scratch, color, False, points[run[0]:run[-1] + 1],
+            width)
+    for dot in points if dots else ():
+      if Rect(dot[0] - 9, dot[1] - 8, 19, 19).collidelist(areas) != -1:
+        pygame.draw.circle(scratch, dark, (dot[0], dot[1] + 1), 8, 0)
+        pygame.draw.circle(scratch, normal, (dot[0], dot[1] + 1), 8, 1)
+    for area in areas:
+      self.track.blit(scratch, area, area)
+    return areas
+
+  def blit_track(self, pos, area=None):
+    return self.screen.blit(self.track, pos, area)
+
+
+class _NoRect(object):
+  """What the NullRenderer draws on: nothing, which is false"""
+  topleft = (0, 0)
+
+  def move(self, x, y):
+    return self
+
+  def union_ip(self, rect):
+    pass
+
+  def __nonzero__(self):
+    return False
+  __bool__ = __nonzero__
+
+
+class _NoSurface(object):
+  """What the NullRenderer returns for sprites, texts and panels"""
+  def get_size(self):
+    return (0, 0)
+
+  def get_width(self):
+    return 0
+
+  def get_height(self):
+    return 0
+
+
+_no_rect = _NoRect()
+_no_surface = _NoSurface()
+
+
+class NullRenderer(object):
+  """
+  Draws nothing and needs neither pygame nor a display, for running
+  draw_game() headless.  Sprites and texts are never rendered.
+  """
+  def open(self):
+    pass
+
+  def fill(self, color, rect=None):
+    return _no_rect
+
+  def blit(self, surface, pos, area=None):
+    return _no_rect
+
+  def circle(self, color, pos, radius, width=0):
+    return _no_rect
+
+  def line(self, color, start, end, width=1):
+    return _no_rect
+
+  def flip(self):
+    pass
+
+  def update(self, rects):
+    pass
+
+  def sprite(self, key, render, *args):
+    return _no_surface
+
+  def text(self, font, line, color=(255, 255, 255)):
+    return _no_surface
+
+  def panel(self, name, font, lines, align_right=False):
+    return _no_surface
+
+  def stamp(self, x, y, colors, key, render, *args):
+    return _no_rect
+
+  def draw_track(self, points, dark, normal, dots):
+    pass
+
+  def move_track(self, old, points):
+    return []
+
+  def blit_track(self, pos, area=None):
+    return _no_rect
+
+
+class CountingRenderer(NullRenderer):
+  """A NullRenderer that counts the calls of every drawing primitive"""
+  primitives = ('fill', 'blit', 'circle', 'line', 'sprite', 'text', 'panel',
+      'stamp', 'draw_track', 'move_track', 'blit_track')
+
+  def __init__(self):
+    self.frames = 0
+    self.counts = dict((name, 0) for name in self.primitives)
+    for name in self.primitives:
+      setattr(self, name, self._counted(name, getattr(self, name)))
+
+  def _counted(self, name, function):
+    counts = self.counts
+    def counted(*args):
+      counts[name] += 1
+      return function(*args)
+    return counted
+
+  def flip(self):
+    self.frames += 1
+
+  def update(self, rects):
+    self.frames += 1
+
+  def report(self):
+    frames = max(1, self.frames)
+    return "draw calls per frame: %s" % ", ".join("%s %.1f" % (name,
+      self.counts[name] / float(frames)) for name in self.primitives)
+
 
-    for mob in self._get_monsters_in_range(self.radius, target.x, target.y):
-      if mob.damage(self.damage + self.bonus_damage, self):
-        self.size += g.growth_per_kill
-        self.update_stats()
-        g.hp = min(g.maxhp, g.hp + g.hp_per_monster)
-        g.score += mob.level
-    if self.bonus_damage:
-      self.bonus_damage = 0
-      self.update_stats()
+_renderers = {'pygame': PygameRenderer, 'null': NullRenderer,
+    'count': CountingRenderer}
+
+
+def _import_numpy():
+  """Import numpy on first use, return whether it is installed"""
+  global numpy, _numpy_missing
+  if numpy is None and not _numpy_missing:
+    try:
+      import numpy
+    except ImportError:
+      _numpy_missing = True
+  return numpy is not None
+
+
+def _import_pygame():
+  """Import pygame and its constants, which only a real display needs"""
+  global pygame
+  if pygame is None:
+    import pygame
+    import pygame.locals
+    globals().update((name, value) for name, value in
+        vars(pygame.locals).items() if not name.startswith('_'))
 
 
 class Wave(object):
+  """
+  Sends a monster, or a swarm of them with --swarm, every self.delay
+  seconds, starting right away
+  """
+  __slots__ = ('level', 'delay', 'last_send', 'monsters_left')
+
   def __init__(self, level):
     self.level = level
     self.delay = 0.3
     self.last_send = 0
     self.monsters_left = 10
+    g.events.at(g.game_time, self.send)
+
+  def send(self):
+    if g.swarm:
+      for _ in range(g.swarm_batch * self.level):
+        spawn_monster(self.level, True)
+    else:
+      spawn_monster(self.level)
+    self.monsters_left -= 1
+    self.last_send = g.game_time
+    if self.monsters_left > 0:
+      g.events.at(self.last_send + self.delay, self.send)
+    else:
+      g.waves.remove(self)
+
+
+def _bench_towers(count, colors, sizes, centers=None):
+  """Place bubbles near the track, or around the given centers"""
+  for i in range(count):
+    tower = Tower()
+    if centers:
+      x, y = g.rng.choice(centers)
+      tower.x, tower.y = x + g.rng.uniform(-60, 60), y + g.rng.uniform(-60, 60)
+    else:
+      x, y = g.rng.choice(g.checkpoints)
+      tower.x, tower.y = x + g.rng.uniform(-80, 80), y + g.rng.uniform(-80, 80)
+    tower.x = min(g.w, max(0, tower.x))
+    tower.y = min(g.h, max(0, tower.y))
+    tower.vx = tower.vy = 0
+    tower.red, tower.green, tower.blue = g.rng.choice(colors)
+    tower.size = g.rng.uniform(*sizes)
+    tower.update_stats()
+    g.towers.append(tower)
+
+
+def _bench_waves():
+  """20 bubbles against overlapping waves from level 30 on"""
+  g.level = 30
+  g.nextwave = 0
+  g.nextwavemax = 1.0
+  _bench_towers(20, [(255, 0, 0), (0, 255, 0), (0, 0, 255), (120, 120, 0),
+    (0, 120, 120), (120, 0, 120)], (30, 80))
+
+
+def _bench_longest_track(monsters, towers, spread, swarm=False):
+  """
+  Spawn monsters along the first part (spread) of the longest track
+  layout, guarded by towers
+  """
+  paths = [Path([(int(x * g.w / 10), int(y * g.h / 10)) for x, y in layout])
+      for layout in g.level_layouts]
+  g.path = max(paths, key=lambda path: path.length)
+  g.checkpoints = [(int(x), int(y)) for x, y in g.path.points]
+  g.base_checkpoints = list(g.checkpoints)
+  g.level = 15
+  g.nextwave = 1e9
+  for i in range(monsters):
+    spawn_monster(g.rng.randint(10, 20), swarm)
+    g.mobs[-1].danger = g.rng.uniform(0, g.path.length * spread)
+  _bench_towers(towers, [(255, 0, 0), (0, 0, 255)], (10, 40))
+
+
+def _bench_swarm():
+  """1200 monsters on the longest track layout"""
+  _bench_longest_track(1200, 10, 0.8)
+
+
+def _bench_horde():
+  """20000 swarm monsters on the longest track layout, and few bubbles"""
+  _bench_longest_track(20000, 2, 0.3, True)
+
+
+def _bench_morph():
+  """600 monsters on a morphing track with 40 checkpoints"""
+  g.morph = True
+  g.checkpoints = [(int(g.w * (i + 0.5) / 40), int(g.h * (0.5 + 0.35 * (
+    -1) ** i * g.rng.random()))) for i in range(40)]
+  g.checkpoints[0] = (0, g.checkpoints[0][1])
+  g.checkpoints[-1] = (g.w, g.checkpoints[-1][1])
+  g.base_checkpoints = list(g.checkpoints)
+  g.path = Path(g.checkpoints)
+  g.level = 15
+  g.nextwave = 1e9
+  for i in range(600):
+    spawn_monster(g.rng.randint(10, 20))
+    g.mobs[-1].danger = g.rng.uniform(0, g.path.length * 0.8)
+  _bench_towers(10, [(255, 0, 0), (0, 0, 255)], (10, 40))
+
+
+def _bench_magenta():
+  """60 bubbles in support clusters, mostly magenta"""
+  g.level = 20
+  g.nextwave = 0
+  g.nextwavemax = 1.0
+  centers = [(g.w * 0.25, g.h * 0.3), (g.w * 0.7, g.h * 0.6)]
+  _bench_towers(40, [(200, 0, 200), (255, 0, 180)], (10, 60), centers)
+  _bench_towers(20, [(255, 0, 0), (0, 255, 0)], (10, 60), centers)
+
+
+def _bench_gravity():
+  """150 massive bubbles under the strongest global gravity"""
+  g.gravity = (0, 0.1)
+  g.nextwave = 1e9
+  for i in range(150):
+    _bench_towers(1, [(255, 0, 0), (100, 100, 100)], (50, 150),
+        [(g.rng.uniform(0, g.w), g.rng.uniform(0, g.h))])
+
+
+_bench_scenarios = [
+  ('waves', _bench_waves),
+  ('swarm', _bench_swarm),
+  ('horde', _bench_horde),
+  ('morph', _bench_morph),
+  ('magenta', _bench_magenta),
+  ('gravity', _bench_gravity),
+]
+
+# subsystem: the functions whose time is attributed to it
+_bench_subsystems = [
+  ('movement', [('module', 'update_waves'), ('module', 'move_monsters')]),
+  ('targeting', [(Tower, '_get_target')]),
+  ('damage', [(Tower, '_hit'), (DamageBatch, 'resolve')]),
+  ('physics', [(Tower, 'move'), ('module', 'apply_gravity'),
+    ('module', 'update_auras')]),
+  ('rendering', [('module', 'draw_game')]),
+]
+
+
+def _bench_timed(function, timings, name):
+  def timed(*args):
+    start = time.time()
+    try:
+      return function(*args)
+    finally:
+      timings[name] += time.time() - start
+  return timed
+
+
+def run_benchmarks():
+  """
+  Run the benchmark scenarios and print the ticks per second of every
+  subsystem.  Returns False on a regression or if gravity engines disagree.
+  """
+  global g
+  import json
+  os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+  module = sys.modules[__name__]
+  argv = [arg for arg in sys.argv if not arg.startswith('--seed=')]
+  names = _option('bench-scenarios')
+  names = names.split(',') if names else [name for name, _ in _bench_scenarios]
+  results = {}
+  for name, setup in _bench_scenarios:
+    if name not in names:
+      continue
+    sys.argv = argv + ['--headless', '--seed=1', '--detail=0']
+    g = Globals()
+    g.hp_damage = 0
+    g.waves_per_level = 10 ** 6
+    init_display('pygame')
+    setup()
+
+    timings = dict((subsystem, 0.0) for subsystem, _ in _bench_subsystems)
+    originals = []
+    for subsystem, functions in _bench_subsystems:
+      for owner, attr in functions:
+        owner = module if owner == 'module' else owner
+        function = owner.__dict__[attr]
+        originals.append((owner, attr, function))
+        setattr(owner, attr, _bench_timed(function, timings, subsystem))
+    sim = Simulation()
+    try:
+      time_before = time.time()
+      for i in range(g.bench_ticks):
+        sim.step()
+        module.draw_game()
+      elapsed = time.time() - time_before
+    finally:
+      for owner, attr, function in originals:
+        setattr(owner, attr, function)
+
+    result = results[name] = {'total': g.bench_ticks / max(1e-9, elapsed)}
+    for subsystem, seconds in timings.items():
+      if seconds > 0:  # some scenarios never shoot, for example
+        result[subsystem] = g.bench_ticks / seconds
+    print("%-10s %8.0f ticks/s  (%s; %d monsters, %d bubbles)" % (name,
+      result['total'], ", ".join("%s %.0f" % (subsystem, result[subsystem])
+        for subsystem, _ in _bench_subsystems if subsystem in result),
+      len(g.mobs), len(g.towers)))
+  sys.argv = argv
+
+  report = {'version': g.version, 'ticks': g.bench_ticks, 'numpy': g.numpy,
+      'python': sys.version.split()[0], 'scenarios': results}
+  if g.bench_out:
+    with open(g.bench_out, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+
+  ok = True
+  if _import_numpy():
+    difference = _gravity_parity()
+    ok = difference < 1e-9
+    print("gravity engines agree with the python one to %.1g%s" % (
+      difference, "" if ok else "  MISMATCH"))
+  if g.bench_baseline:
+    with open(g.bench_baseline) as f:
+      baseline = json.load(f)['scenarios']
+    for name in sorted(results):
+      for subsystem in sorted(results[name]):
+        before = baseline.get(name, {}).get(subsystem)
+        if not before:
+          continue
+        ratio = results[name][subsystem] / before
+        regressed = ratio < 1 - g.bench_threshold
+        ok = ok and not regressed
+        print("%-10s %-10s %6.2fx%s" % (name, subsystem, ratio,
+          "  REGRESSION" if regressed else ""))
+  return ok
+
+
+def run_sweep():
+  """
+  Play g.sweep_games headless games for every combination of the --vary
+  settings in worker processes, and print how each did on average
+  """
+  import json
+  import multiprocessing
+  knobs = []
+  for arg in sys.argv:
+    if arg.startswith('--vary='):
+      name, values = arg[len('--vary='):].split('=', 1)
+      if name not in g.settings:  # e.g. hp is reset for every game
+        raise ValueError("not a setting that can be varied: %s" % name)
+      if ':' in values:
+        knobs.append((name, tuple(_parse_knob(v) for v in values.split(':'))))
+      else:
+        knobs.append((name, [_parse_knob(v) for v in values.split(',')]))
+  names = [name for name, _ in knobs]
+
+  if g.sweep_samples:
+    rng = Random(g.seed)
+    combos = []
+    for i in range(int(g.sweep_samples)):
+      combo = []
+      for name, values in knobs:
+        if isinstance(values, list):
+          combo.append(rng.choice(values))
+        elif all(isinstance(v, int) for v in values):
+          combo.append(rng.randint(*values))
+        else:
+          combo.append(rng.uniform(*values))
+      combos.append(tuple(combo))
+  else:
+    if any(isinstance(values, tuple) for _, values in knobs):
+      raise ValueError("ranges of values need --sweep-samples")
+    combos = [()]
+    for name, values in knobs:
+      combos = [combo + (value,) for combo in combos for value in values]
+
+  argv = [arg for arg in sys.argv if arg.split('=')[0] not in
+      ('--seed', '--record', '--replay', '--sweep')]
+  jobs = [(argv, list(zip(names, combo)), g.seed + i)
+      for combo in combos for i in range(g.sweep_games)]
+  print("%d combinations, %d games of %d ticks" % (len(combos), len(jobs),
+    g.ticks))
+
+  time_before = time.time()
+  processes = int(g.sweep_jobs) if g.sweep_jobs else None
+  pool = multiprocessing.Pool(processes)
+  try:
+    games = []
+    for game in pool.imap_unordered(_sweep_game, jobs):
+      games.append(game)
+      if len(games) % 100 == 0:
+        print("%d/%d games" % (len(games), len(jobs)))
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  elapsed = time.time() - time_before
+  print("%d games in %.1fs, %.0f games per hour" % (len(games), elapsed,
+    len(games) / max(1e-9, elapsed) * 3600))
+
+  results = {}
+  for game in games:
+    results.setdefault(tuple(game[name] for name in names), []).append(game)
+  summary = []
+  for combo, played in results.items():
+    row = dict(zip(names, combo))
+    row['games'] = len(played)
+    for field in ('waves', 'score', 'us_per_tick'):
+      row[field] = sum(game[field] for game in played) / float(len(played))
+    row['min_waves'] = min(game['waves'] for game in played)
+    row['survived'] = sum(not game['lost'] for game in played) / float(len(played))
+    summary.append(row)
+  summary.sort(key=lambda row: (-row['waves'], -row['score']))
+
+  print(" ".join("%12s" % column for column in
+    names + ['waves', 'min_waves', 'survived', 'score', 'us/tick']))
+  for row in summary:
+    print(" ".join("%12s" % _format_knob(row[column]) for column in
+      names + ['waves', 'min_waves', 'survived', 'score', 'us_per_tick']))
+
+  if g.sweep_out:
+    columns = names + ['seed', 'ticks', 'waves', 'score', 'hp', 'lost',
+        'towers', 'game_time', 'us_per_tick']
+    games.sort(key=lambda game: [game[column] for column in columns])
+    with open(g.sweep_out, 'w') as f:
+      if g.sweep_out.endswith('.json'):
+        json.dump({'version': g.version, 'ticks': g.ticks,
+          'policy': g.policy, 'knobs': dict(knobs), 'summary': summary,
+          'games': games}, f, indent=2, sort_keys=True)
+      else:
+        f.write(",".join(columns) + "\n")
+        for game in games:
+          f.write(",".join(str(game[column]) for column in columns) + "\n")
+
+
+def _sweep_game(job):
+  """Play one game of a sweep, in a worker process"""
+  global g
+  argv, knobs, seed = job
+  sys.argv = argv + ['--headless', '--seed=%d' % seed]
+  g = Globals()
+  for name, value in knobs:
+    if name == 'level_layouts':  # play only the layout with that index
+      value = [g.level_layouts[value]]
+    setattr(g, name, value)
+  # start over so that the changed settings apply from the first tick
+  g.rng.seed(seed)
+  g.reset_game()
+
+  sim = Simulation(policy=_make_policy(g.policy))
+  time_before = time.time()
+  sim.run(g.ticks)
+  elapsed = time.time() - time_before
+  game = dict(knobs)
+  game.update(seed=seed, ticks=sim.ticks, waves=g.level, score=g.score,
+      hp=round(max(0, g.hp), 3), lost=g.hp <= 0, towers=len(g.towers),
+      game_time=round(g.game_time, 3),
+      us_per_tick=round(elapsed / max(1, sim.ticks) * 1e6, 1))
+  return game
+
+
+def _parse_knob(text):
+  """Read a number or a boolean from the command line"""
+  for convert in (int, float):
+    try:
+      return convert(text)
+    except ValueError:
+      pass
+  if text in ('True', 'False'):
+    return text == 'True'
+  raise ValueError("not a number: %s" % text)
 
-  def tick(self):
-    if self.last_send + self.delay < g.game_time:
-      g.mobs.append(Monster(self.level))
-      self.monsters_left -= 1
-      self.last_send = g.game_time
+
+def _format_knob(value):
+  if isinstance(value, float):
+    return "%.3g" % value
+  return str(value)
 
 
 def keypress(key):
+  shift = pygame.key.get_mods() & KMOD_SHIFT
   if key == K_ESCAPE:
     raise SystemExit()
   elif key == K_F1:
-    g.log(*__doc__.split("\n")[8:])
+    lines = __doc__.split("\n")
+    g.log(*lines[lines.index("Key bindings:") - 1:])
   elif key == K_F8:
-    g.reset_game()
+    command('reset')
   elif key == K_F11:
     pygame.display.toggle_fullscreen()
+    g.redraw = True
   elif key == K_F5:
     g.logged.clear()
+  elif key == K_F9:
+    g.timer.overlay ^= True
+    g.timer.lines = None
+  elif key == K_BACKSPACE:
+    command('rewind')
+  elif key == K_F6:
+    save_game(g.savefile)
+    g.log("Saved the game to %s" % g.savefile)
+  elif key == K_F7:
+    if g.recorder:
+      g.log("Can't load a game while recording")
+    elif os.path.exists(g.savefile):
+      load_game(g.savefile)
+      g.log("Loaded the game from %s" % g.savefile)
   elif key in (K_n, K_F3):
-    g.nextwave = 0
+    command('next_wave')
+  elif key in (K_f, K_F4):
+    g.fast_forward.cycle()
+    g.log("Speed: %dx" % g.fast_forward.chosen)
   elif key == K_d:
-    if pygame.key.get_mods() & KMOD_SHIFT and g.active:
-      g.towers.remove(g.active)
-      g.active = g.towers[0] if g.towers else None
-      g.drag = None
+    if shift:
+      command('destroy')
   elif key in (K_c, K_F2):
-    if len(g.towers) < g.max_towers:
-      g.towers.append(Tower())
-      g.active = g.towers[-1]
+    command('create')
   elif key == K_SPACE:
-    g.pause ^= True
+    command('pause')
   elif key in range(K_1, K_9 + 1):
-    if len(g.towers) > key - K_1:
-      g.active = g.towers[key - K_1]
+    command('select', key - K_1)
   elif key == K_0:
-    if len(g.towers):
-      g.active = g.towers[-1]
+    command('select', -1)
   elif key in (K_r, K_g, K_b):
-    if g.active:
-      c = {K_r: "red", K_g: "green", K_b: "blue"}[key]
-      if pygame.key.get_mods() & KMOD_SHIFT:
-        if g.active.__dict__[c] > 0:
-          g.active.__dict__[c] = max(0, g.active.__dict__[c] - g.color_step)
-      else:
-        if g.hp >= g.min_hp_for_buying and g.active.__dict__[c] < 255:
-          g.hp -= g.hp_cost
-          g.active.__dict__[c] = min(255, g.active.__dict__[c] + g.color_step)
-      g.active.update_stats()
+    c = {K_r: "red", K_g: "green", K_b: "blue"}[key]
+    command('paint', c, -1 if shift else 1)
   elif key == K_TAB:
-    if g.active:
-      g.active = g.towers[(g.towers.index(g.active) + \
-          (-1 if (pygame.key.get_mods() & KMOD_SHIFT) else 1)) % len(g.towers)]
-    elif g.towers:
-      g.active = g.towers[0]
+    command('cycle', -1 if shift else 1)
 
 
 def keyhold(pressed):
-  if (pressed[K_j] or pressed[K_s] or pressed[K_DOWN]) and g.active:
-    g.active.vy += 30.0 * g.active.inertia * g.dt
-  if (pressed[K_k] or pressed[K_w] or pressed[K_UP]) and g.active:
-    g.active.vy -= 30.0 * g.active.inertia * g.dt
-  if (pressed[K_h] or pressed[K_a] or pressed[K_LEFT]) and g.active:
-    g.active.vx -= 30.0 * g.active.inertia * g.dt
-  if (pressed[K_l] or pressed[K_d] or pressed[K_RIGHT]) and g.active:
-    g.active.vx += 30.0 * g.active.inertia * g.dt
+  dx = dy = 0
+  if pressed[K_j] or pressed[K_s] or pressed[K_DOWN]:
+    dy += 1
+  if pressed[K_k] or pressed[K_w] or pressed[K_UP]:
+    dy -= 1
+  if pressed[K_h] or pressed[K_a] or pressed[K_LEFT]:
+    dx -= 1
+  if pressed[K_l] or pressed[K_d] or pressed[K_RIGHT]:
+    dx += 1
+  if (dx or dy) and g.active:
+    command('push', dx, dy)
+  if g.drag:
+    mouse = pygame.mouse.get_pos()
+    if mouse != g.mouse:
+      command('mouse', mouse[0], mouse[1])
 
 
 def click(action, pos, button):
   if button == 1:
     if action == MOUSEBUTTONDOWN:
-      for tower in reversed(g.towers):
-        if tower.distance(pos[0], pos[1]) <= tower.radius:
-          g.drag = tower
-          g.active = tower
-          break
-      else:
-        g.active = None
+      command('grab', pos[0], pos[1])
     elif action == MOUSEBUTTONUP:
-      g.drag = None
+      command('release')
   elif button == 3:
+    command('deselect')
+
+
+def command(name, *args):
+  """
+  Carry out an action of the player.  All input that affects the game goes
+  through here, to be recorded, replayed or handed to the simulation thread.
+  """
+  if g.simulation_thread and g.simulation_thread.call(command, name, *args):
+    return
+  if g.recorder:
+    g.recorder.record(name, args)
+  if name == 'reset':
+    g.reset_game()
+    if g.rewind:
+      g.rewind.clear()
+  elif name == 'rewind':
+    if g.rewind and g.rewind.rewind():
+      g.log("Rewound to %.0fs" % g.game_time)
+  elif name == 'next_wave':
+    g.nextwave = 0
+  elif name == 'destroy':
+    if g.active:
+      if g.active.ready_event:
+        g.events.cancel(g.active.ready_event)
+      g.towers.remove(g.active)
+      g.active = g.towers[0] if g.towers else None
+      g.drag = None
+  elif name == 'create':
+    if len(g.towers) < g.max_towers:
+      g.towers.append(Tower())
+      g.active = g.towers[-1]
+  elif name == 'pause':
+    g.pause ^= True
+  elif name == 'select':
+    if -len(g.towers) <= args[0] < len(g.towers):
+      g.active = g.towers[args[0]]
+  elif name == 'cycle':
+    if g.active:
+      g.active = g.towers[(g.towers.index(g.active) + args[0]) % len(g.towers)]
+    elif g.towers:
+      g.active = g.towers[0]
+  elif name == 'paint':
+    c, direction = args
+    if g.active:
+      value = getattr(g.active, c)
+      if direction < 0:
+        if value > 0:
+          setattr(g.active, c, max(0, value - g.color_step))
+      else:
+        if g.hp >= g.min_hp_for_buying and value < 255:
+          g.hp -= g.hp_cost
+          setattr(g.active, c, min(255, value + g.color_step))
+      g.active.update_stats()
+  elif name == 'push':
+    if g.active:
+      g.active.vx += args[0] * 30.0 * g.active.inertia * g.dt
+      g.active.vy += args[1] * 30.0 * g.active.inertia * g.dt
+  elif name == 'mouse':
+    g.mouse = args
+  elif name == 'grab':
+    g.mouse = args
+    for tower in reversed(g.towers):
+      if tower.distance(args[0], args[1]) <= tower.radius:
+        g.drag = tower
+        g.active = tower
+        break
+    else:
+      g.active = None
+  elif name == 'release':
+    g.drag = None
+  elif name == 'deselect':
     g.active = None
 
 
+class HighscoreStore(object):
+  """
+  The best scores, highest first, in a file that games ending at the same
+  time can safely add to.  Old files are converted on the next write.
+  """
+  header = "wabbel-highscores 1"
+
+  def __init__(self, path, limit):
+    self.path = path
+    self.limit = limit
+    self.keys = []  # negated scores, ascending, for bisect
+    self.entries = []
+
+  def load(self):
+    self.keys, self.entries = [], []
+    try:
+      lines = open(self.path, "r").read().splitlines()
+    except (IOError, OSError):
+      return
+    if lines and lines[0] == self.header:
+      # Already sorted and bounded, no need to sort again
+      for line in lines[1:self.limit + 1]:
+        entry = _parse_highscore(line)
+        if entry:
+          self.keys.append(-entry[0])
+          self.entries.append(entry)
+    else:
+      # ties end up in the order that sorting and reversing gave them
+      for line in lines:
+        entry = _parse_highscore(line)
+        if entry:
+          self.insert(*entry, newest_first=True)
+
+  def insert(self, score, name, newest_first=False):
+    """
+    Add an entry, returns its rank or None if it's too low.  Its place is
+    found in O(log N), but inserting it there takes O(N).
+    """
+    bisect = bisect_left if newest_first else bisect_right
+    rank = bisect(self.keys, -score)
+    if rank >= self.limit:
+      return None
+    self.keys.insert(rank, -score)
+    self.entries.insert(rank, (score, name))
+    if len(self.entries) > self.limit:
+      del self.keys[self.limit:], self.entries[self.limit:]
+    return rank
+
+  def add(self, score, name):
+    """Merge a new score into the file, returns its rank or None"""
+    lock = self._lock()
+    try:
+      self.load()
+      rank = self.insert(score, name, newest_first=True)
+      if rank is not None:
+        self.save()
+      return rank
+    finally:
+      if lock:
+        lock.close()
+
+  def save(self):
+    directory = os.path.dirname(os.path.abspath(self.path))
+    fd, tmp = tempfile.mkstemp(prefix=".wabbel_highscore.", dir=directory)
+    try:
+      f = os.fdopen(fd, "w")
+      f.write(self.header + "\n")
+      f.writelines("%d\t%s\n" % entry for entry in self.entries)
+      f.flush()
+      os.fsync(f.fileno())
+      f.close()
+      try:
+        os.chmod(tmp, os.stat(self.path).st_mode & 0o777)
+      except OSError:
+        os.chmod(tmp, 0o644)
+      try:
+        os.rename(tmp, self.path)
+      except OSError:  # windows won't rename over an existing file
+        os.remove(self.path)
+        os.rename(tmp, self.path)
+    except:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      raise
+
+  def lines(self, n):
+    return ["%d - %s" % entry for entry in self.entries[:n]]
+
+  def _lock(self):
+    """
+    Take an exclusive lock on the score file, if possible.  Since save()
+    replaces the file, the lock is taken again if that happened meanwhile.
+    """
+    if fcntl is None:
+      return None
+    while True:
+      try:
+        lock = open(self.path, "a")
+      except IOError:
+        return None
+      fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+      try:
+        if os.fstat(lock.fileno()).st_ino == os.stat(self.path).st_ino:
+          return lock
+      except OSError:
+        pass
+      lock.close()
+
+
+# The format of snapshots: a header, the state of the random numbers and
+# then columns of the track (as it is and as laid out), bubbles, monsters
+# and waves.  The columns are
+# arrays of one attribute each, so that they can be written and read in
+# one go, and so that little changes between two snapshots.
+_snapshot_header = struct.Struct('<4sqdddiq?dddddBBBiHIIH?d')
+_snapshot_random = struct.Struct('<B625I')
+_snapshot_towers = (('B', ('red', 'green', 'blue')), ('i', ('stats_size',)),
+    ('d', ('size', 'x', 'y', 'vx', 'vy', 'last_shot', 'phase', 'bonus_damage')))
+_snapshot_mobs = (('d', ('hp', 'maxhp', 'speed', 'original_speed', 'danger',
+    'phase', 'armor', 'original_armor', 'x', 'y')), ('i', ('level',
+    'checkpoint')), ('B', ('square', 'swarm')))
+_snapshot_waves = (('d', ('delay', 'last_send')), ('i', ('level',
+    'monsters_left')))
+_tobytes = getattr(array, 'tobytes', None) or array.tostring
+_frombytes = getattr(array, 'frombytes', None) or array.fromstring
+
+
+def snapshot():
+  """The state of the game as a compact string of bytes, see restore()"""
+  version, state, gauss = g.rng.getstate()
+  store = g.monster_store
+  mobs = g.mobs
+  columns = [_snapshot_header.pack(b'wbl4', g.tick, g.game_time, g.hp,
+    g.maxhp, g.level, g.score, g.pause, g.shake_until,
+    g.wave_event[0], g.nextwavemax, g.gravity[0], g.gravity[1],
+    g.level_color[0], g.level_color[1], g.level_color[2],
+    g.towers.index(g.active) if g.active in g.towers else -1,
+    len(g.checkpoints), len(g.towers), len(mobs), len(g.waves),
+    gauss is not None, gauss or 0.0), _snapshot_random.pack(version, *state),
+    _tobytes(array('i', [c for point in g.checkpoints for c in point])),
+    _tobytes(array('i', [c for point in g.base_checkpoints for c in point]))]
+  for typecode, names in _snapshot_towers:
+    for name in names:
+      columns.append(_tobytes(array(typecode, [getattr(tower, name)
+        for tower in g.towers])))
+  for typecode, names in _snapshot_mobs:
+    for name in names:
+      if store is not None and name in store.fields:
+        columns.append(getattr(store, name)[:store.n].astype(typecode).tobytes())
+      else:
+        columns.append(_tobytes(array(typecode, [getattr(mob, name)
+          for mob in mobs])))
+  if store is not None:
+    color = store.color[:store.n]
+    columns.append(numpy.column_stack((color >> 16, color >> 8 & 255,
+      color & 255)).astype('B').tobytes())
+  else:
+    columns.append(_tobytes(array('B', [c for mob in mobs
+      for c in mob.original_color])))
+  for typecode, names in _snapshot_waves:
+    for name in names:
+      columns.append(_tobytes(array(typecode, [getattr(wave, name)
+        for wave in g.waves])))
+  return b''.join(columns)
+
+
+def restore(data):
+  """
+  Continue the game from a snapshot.  The message log and the tick count
+  stay as they are, so that recordings of the game still work.
+  """
+  header = _snapshot_header.unpack_from(data)
+  (magic, tick, game_time, hp, maxhp, level, score, pause, shake_until,
+      wave_due, nextwavemax, gravity_x, gravity_y, red, green, blue, active,
+      checkpoints, towers, mobs, waves, has_gauss, gauss) = header
+  if magic != b'wbl4':
+    raise ValueError("not a snapshot of this version of wabbel")
+  offset = [_snapshot_header.size]
+
+  def read(typecode, n):
+    column = array(typecode)
+    end = offset[0] + column.itemsize * n
+    _frombytes(column, data[offset[0]:end])
+    offset[0] = end
+    return column.tolist()
+
+  random = _snapshot_random.unpack_from(data, offset[0])
+  offset[0] += _snapshot_random.size
+  rewind, logged = g.rewind, g.logged
+  g.reset_game()
+  g.rewind, g.logged = rewind, logged
+  g.rng.setstate((random[0], random[1:], gauss if has_gauss else None))
+  g.game_time, g.hp, g.maxhp, g.level, g.score = game_time, hp, maxhp, level, score
+  g.pause, g.shake_until, g.nextwavemax = pause, shake_until, nextwavemax
+  g.gravity = (gravity_x, gravity_y)
+  g.level_color = [red, green, blue]
+  points = read('i', checkpoints * 2)
+  g.checkpoints = list(zip(points[::2], points[1::2]))
+  points = read('i', checkpoints * 2)
+  g.base_checkpoints = list(zip(points[::2], points[1::2]))
+  g.path = Path(g.checkpoints)
+  g.events.cancel(g.wave_event)
+  g.wave_event = g.events.at(wave_due, _send_wave)
+
+  g.towers = [Tower.__new__(Tower) for _ in range(towers)]
+  for typecode, names in _snapshot_towers:
+    for name in names:
+      for tower, value in zip(g.towers, read(typecode, towers)):
+        setattr(tower, name, value)
+  for tower in g.towers:
+    tower.ready, tower.ready_event, tower.shot_delay = False, None, None
+    tower._stats, tower.target_point = None, None
+    # bubbles grow between updates of their stats, see Tower.shoot()
+    tower.update_stats(tower.stats_size)
+  g.active = g.towers[active] if active >= 0 else None
+
+  cls = StoredMonster if g.monster_store is not None else Monster
+  for _ in range(mobs):
+    mob = cls.pool.pop() if cls.pool else cls.__new__(cls)
+    if cls is Monster:
+      g.mobs.append(mob)
+    else:
+      g.monster_store.add(mob)
+  for typecode, names in _snapshot_mobs:
+    for name in names:
+      for mob, value in zip(g.mobs, read(typecode, mobs)):
+        setattr(mob, name, value)
+  colors = read('B', mobs * 3)
+  for i, mob in enumerate(g.mobs):
+    mob.square, mob.swarm = bool(mob.square), bool(mob.swarm)
+    mob.original_color = tuple(colors[i * 3:i * 3 + 3])
+
+  g.waves = [Wave.__new__(Wave) for _ in range(waves)]
+  for typecode, names in _snapshot_waves:
+    for name in names:
+      for wave, value in zip(g.waves, read(typecode, waves)):
+        setattr(wave, name, value)
+  for wave in g.waves:
+    g.events.at(wave.last_send + wave.delay, wave.send)
+  g.redraw = True
+
+
+def _xor(a, b):
+  """XOR two strings of bytes, the shorter one padded with zeros"""
+  n = max(len(a), len(b))
+  if _import_numpy():
+    return (numpy.frombuffer(a.ljust(n, b'\0'), numpy.uint8) ^
+        numpy.frombuffer(b.ljust(n, b'\0'), numpy.uint8)).tobytes()
+  # a machine word at a time
+  words = array('L')
+  n_words = -(-n // words.itemsize)
+  x = array('L', a.ljust(n_words * words.itemsize, b'\0'))
+  y = array('L', b.ljust(n_words * words.itemsize, b'\0'))
+  words.extend(map(xor, x, y))
+  return _tobytes(words)[:n]
+
+
+class RewindBuffer(object):
+  """
+  The snapshots of the last few seconds, the older ones stored as the
+  compressed XOR with the next one
+  """
+  def __init__(self, size):
+    self.size = size
+    self.clear()
+
+  def clear(self):
+    self.newest = None  # (tick, snapshot)
+    self.older = deque()  # (tick, length, compressed XOR with the next one)
+
+  def take(self):
+    data = snapshot()
+    if self.newest is not None and self.newest[0] != g.tick:
+      tick, previous = self.newest
+      self.older.append((tick, len(previous),
+        zlib.compress(_xor(previous, data), 1)))
+      if len(self.older) >= self.size:
+        self.older.popleft()
+    self.newest = (g.tick, data)
+
+  def rewind(self):
+    """
+    Go back to the newest snapshot, or to the one before if the newest was
+    taken less than half a second ago.  Returns whether there was one.
+    """
+    if self.newest is None:
+      return False
+    if g.tick - self.newest[0] < g.maxfps // 2 and self.older:
+      tick, length, delta = self.older.pop()
+      older = _xor(self.newest[1], zlib.decompress(delta))[:length]
+      self.newest = (tick, older)
+    restore(self.newest[1])
+    # the game continues from here now, so the next rewind goes further back
+    self.newest = (g.tick, self.newest[1])
+    return True
+
+
+def save_game(path):
+  if g.simulation_thread and g.simulation_thread.call(save_game, path):
+    return
+  with open(path, 'wb') as f:
+    f.write(b"wabbel-snapshot 1\n" + zlib.compress(snapshot()))
+
+
+def load_game(path):
+  if g.simulation_thread and g.simulation_thread.call(load_game, path):
+    return
+  data = open(path, 'rb').read()
+  header, _, body = data.partition(b"\n")
+  if header != b"wabbel-snapshot 1":
+    raise ValueError("%s is not a saved wabbel game" % path)
+  restore(zlib.decompress(body))
+
+
+class Recorder(object):
+  """
+  Writes the commands of a game to a file, with the seed and options first
+  and the final state last, for run_replay()
+  """
+  def __init__(self, path):
+    self.file = open(path, 'w')
+    options = [arg for arg in sys.argv[1:] if arg.split('=')[0] not in
+        ('--record', '--seed', '--fullscreen', '--profile')]
+    self.file.write(" ".join(["wabbel-replay", "1", str(g.seed)] + options) + "\n")
+
+  def record(self, name, args):
+    self.file.write(" ".join([str(g.tick), name] + [str(a) for a in args]) + "\n")
+
+  def close(self):
+    self.file.write("end %s\n" % _summary())
+    self.file.close()
+
+
+def run_replay(path):
+  """
+  Play back a recorded game at a fixed timestep as fast as possible and
+  check that it ends in the same state.  Returns whether it did.
+  """
+  global g
+  lines = open(path).read().splitlines()
+  header = lines[0].split()
+  if header[:2] != ["wabbel-replay", "1"]:
+    raise ValueError("%s is not a wabbel replay" % path)
+  sys.argv = [sys.argv[0], '--headless', '--seed=' + header[2]] + header[3:] + \
+      [arg for arg in sys.argv[1:] if not arg.startswith('--replay=')]
+  g = Globals()
+  if g.resume:
+    raise ValueError("%s continues a saved game, which can't be replayed" % path)
+
+  commands = {}
+  expected = None
+  for line in lines[1:]:
+    fields = line.split()
+    if fields[0] == 'end':
+      expected = " ".join(fields[1:])
+      break
+    args = tuple(int(f) if f.lstrip('-').isdigit() else f for f in fields[2:])
+    commands.setdefault(int(fields[0]), []).append((fields[1], args))
+    if fields[1] == 'rewind' and g.rewind_seconds and not g.rewind:
+      g.rewind = RewindBuffer(g.rewind_seconds)
+
+  def replay(sim):
+    for name, args in commands.get(g.tick, ()):
+      command(name, *args)
+
+  end = int(expected.split()[0]) if expected else max(commands or [0]) + 1
+  sim = Simulation(policy=replay)
+  time_before = time.time()
+  while g.tick < end:
+    sim.step()
+  elapsed = max(1e-9, time.time() - time_before)
+  print("replayed %d ticks in %.2fs, %.0f ticks per second" % (
+    sim.ticks, elapsed, sim.ticks / elapsed))
+  print("final state: %s" % _summary())
+  if expected is None:
+    print("the recording has no final state to compare with")
+    return True
+  if expected != _summary():
+    print("MISMATCH, expected: %s" % expected)
+    return False
+  return True
+
+
 def _draw_bar(x, y, length, width, color):
   if length > 0:
-    pygame.draw.line(g.screen, color, (x, y), (x + length, y), width)
+    return g.renderer.line(color, (x, y), (x + length, y), width)
 
 
-def _random_color(maximum):
-  color = [random(), random(), random()]
+_colorkey = (1, 1, 1)
+
+
+def _surface_bytes(surface):
+  return surface.get_pitch() * surface.get_height()
+
+
+def _sprite_surface(width, height):
+  """
+  An empty surface for a sprite.  The transparent color key can't occur
+  in quantized colors or bubble colors.
+  """
+  surface = pygame.Surface((width, height))
+  surface.fill(_colorkey)
+  surface.set_colorkey(_colorkey, RLEACCEL)
+  return surface
+
+
+def _bounding_rect(points):
+  """The smallest Rect that contains the points"""
+  xs = [p[0] for p in points]
+  ys = [p[1] for p in points]
+  return Rect(min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1)
+
+
+def _quantize_color(color):
+  """Round the channels to the nearest multiple of g.sprite_color_step"""
+  step = g.sprite_color_step
+  return tuple(min(255, (int(c) + step // 2) // step * step) for c in color)
+
+
+def _random_color(maximum, rng):
+  color = [rng.random(), rng.random(), rng.random()]
   return [min(255, int(maximum / sum(color) * n)) for n in color]
 
 
-def _highscore_sorting_key(line):
+def _summary():
+  """The state of the game in a line, to compare replays"""
+  return "%d %d %d %.6f %d %d" % (g.tick, g.level, g.score, g.hp,
+      len(g.mobs), len(g.towers))
+
+
+def _option(name, default=None):
+  """Return the value of a --name=value command line option"""
+  prefix = '--%s=' % name
+  for arg in sys.argv:
+    if arg.startswith(prefix):
+      return arg[len(prefix):]
+  return default
+
+
+def _get_danger(mob):
+  return mob.danger
+
+
+def _parse_highscore(line):
+  """Read "score<tab>name" or the old "score - name", None if neither"""
+  if "\t" in line:
+    score, name = line.split("\t", 1)
+  else:
+    score, _, name = line.partition(" - ")
   try:
-    return int(line.split()[0])
-  except:
-    return 0
+    return int(score), name
+  except ValueError:
+    return None
 
 
 if __name__ == '__main__':
   global g
   g = Globals()
+  if g.resume:
+    if g.record or g.replay or g.bench or g.sweep:
+      # replays, benchmarks and sweeps start new games
+      raise ValueError("--resume can't be combined with --record, "
+          "--replay, --bench or --sweep")
+    load_game(g.resume)
 
   if '--help' in sys.argv or '-h' in sys.argv:
     print(__doc__)
   elif '--version' in sys.argv:
     print(g.version)
 
+  elif g.replay:
+    sys.exit(0 if run_replay(g.replay) else 1)
+
+  elif g.bench:
+    sys.exit(0 if run_benchmarks() else 1)
+
+  elif g.sweep:
+    run_sweep()
+
+  elif g.headless:
+    run_headless()
+
   else:
     if g.profile:
       import cProfile